@@ -0,0 +1,7 @@
+'''Benchmarks for SBEMDB on synthetic databases
+
+SYNTHETIC.MAKE_SBEMDB creates databases of any size with the same schema
+as the published one; RUNNER.RUN times the query and analysis functions
+on them. From the command line: python3 -m leechem.bench.runner -h'''
+
+from . import synthetic
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+import numpy as np
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+from .. import sbemdb
+from .. import tree
+from .. import distancematrix
+from .. import findpath
+from .. import forest
+from . import synthetic
+
+# Database sizes to benchmark, as arguments to SYNTHETIC.MAKE_SBEMDB
+SIZES = {
+    'small': { 'ntrees': 10, 'nodes': 500 },
+    'medium': { 'ntrees': 40, 'nodes': 2000 },
+    'large': { 'ntrees': 100, 'nodes': 5000 },
+}
+
+class Context:
+    '''CONTEXT - Test subjects picked from a database
+    ctx = CONTEXT(db) picks a tree with many nodes and incoming synapses
+    (TID), its soma (SOMA), a few of its nodes (NIDS), and a point near
+    the middle of the tree (XYZ), for use as arguments to the
+    benchmarked functions.'''
+    def __init__(self, db):
+        cnt = db.fetch('''select b.tid, count(1) as n from nodes as b
+                       inner join syncons as sc on sc.nid==b.nid
+                       where b.typ==6 group by b.tid order by n desc
+                       limit 1''')
+        if cnt:
+            self.tid = cnt[0][0]
+        else:
+            self.tid = db.fetch('select tid from trees limit 1')[0][0]
+        self.soma = db.somaxyz(self.tid)[3]
+        nodes = db.treenodes(self.tid)
+        rng = np.random.default_rng(0)
+        self.nids = rng.choice(nodes.nid, min(100, len(nodes)),
+                               replace=False)
+        self.far = db.farthestNode(self.soma)
+        k = len(nodes) // 2
+        self.xyz = np.array([nodes.x[k], nodes.y[k], nodes.z[k]])
+
+def _reset(db):
+    # Forget everything that SBEMDB caches between calls
+    db.dropsnapshot()
+    if db.qcache is not None:
+        db.qcache.clear()
+    findpath.GRAPHS.clear()
+
+def _prune(db, ctx):
+    t = tree.Tree(ctx.soma, db)
+    t.prune_stubs(db, 2.0)
+
+def _sweep(db, ctx):
+    t = tree.Tree(ctx.soma, db)
+    t.prune_sweep(db, [0.5, 1.0, 2.0, 4.0, 8.0])
+
+# Benchmarks as (name, function). Each function is called with an SBEMDB
+# and a CONTEXT, after calling _RESET on the SBEMDB.
+BENCHMARKS = [
+    ('nodexyz/all', lambda db, c: db.nodexyz()),
+    ('nodexyz/tree', lambda db, c: db.nodexyz(sbemdb.Filter(tid=c.tid))),
+    ('nodexyzMany', lambda db, c: db.nodexyzMany(c.nids)),
+    ('nodeDetails/tree', lambda db, c: db.nodeDetails(f'tid={c.tid}')),
+    ('nodeDetailsMany', lambda db, c: db.nodeDetailsMany(c.nids)),
+    ('treenodes', lambda db, c: db.treenodes(c.tid)),
+    ('treecons', lambda db, c: db.treecons(c.tid)),
+    ('synapses/all', lambda db, c: db.synapses(extended=True)),
+    ('synapses/post', lambda db, c: db.synapses(f'post.tid={c.tid}', True)),
+    ('presyntrees', lambda db, c: db.presyntrees(c.tid)),
+    ('connectivity', lambda db, c: db.connectivity()),
+    ('simplesegments', lambda db, c: db.simplesegments(c.tid)),
+    ('segments', lambda db, c: db.segments(c.tid)),
+    ('segmentarray', lambda db, c: db.segmentarray(c.tid)),
+    ('distanceAlongTree', lambda db, c: db.distanceAlongTree(c.soma)),
+    ('farthestNode', lambda db, c: db.farthestNode(c.soma)),
+    ('pathBetweenNodes', lambda db, c: db.pathBetweenNodes(c.soma, c.far)),
+    ('pathDistances', lambda db, c: db.pathDistances(c.nids, c.nids)),
+    ('nodesNear', lambda db, c: db.nodesNear(c.xyz, 10)),
+    ('nearestNodes', lambda db, c: db.nearestNodes(c.xyz, 10)),
+    ('snapshot', lambda db, c: db.snapshot()),
+    ('synapse_distance_matrix',
+     lambda db, c: distancematrix.synapse_distance_matrix(db, c.tid)),
+    ('Tree', lambda db, c: tree.Tree(c.soma, db)),
+    ('Tree.prune_stubs', _prune),
+    ('Tree.prune_sweep', _sweep),
+    ('Forest', lambda db, c: forest.Forest(db, verbose=False)),
+    ('find_path', lambda db, c: findpath.find_path(db, c.soma, c.far)),
+    ('find_paths', lambda db, c: findpath.find_paths(
+        db, list(zip(c.nids[:-1], c.nids[1:])))),
+    ('find_path_ext',
+     lambda db, c: findpath.find_path_ext(db, post_tid=c.tid)),
+]
+
+def _time(fn, db, ctx, repeat):
+    times = []
+    for k in range(repeat):
+        _reset(db)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            fn(db, ctx)
+            times.append(time.perf_counter() - t0)
+    return times
+
+def environment():
+    '''ENVIRONMENT - Description of the machine and software versions'''
+    return { 'python': platform.python_version(),
+             'numpy': np.__version__,
+             'sqlite': sqlite3.sqlite_version,
+             'platform': platform.platform(),
+             'machine': platform.machine(),
+             'date': time.strftime('%Y-%m-%d %H:%M:%S') }
+
+def run(sizes=None, ofn=None, repeat=3, only=None, workdir=None,
+        verbose=True):
+    '''RUN - Time SBEMDB queries and analyses on synthetic databases
+    res = RUN() creates a synthetic database for each of the SIZES,
+    times each of the BENCHMARKS on it REPEAT times, and returns the
+    results as a dict with keys ENVIRONMENT and RESULTS. The latter is
+    a list of dicts, one per size and benchmark, with the name of the
+    SIZE and its parameters (PARAMS), the row COUNTS of the database,
+    the name of the BENCHMARK, all TIMES (in seconds), and the BEST
+    (minimum) and MEDIAN of those. Benchmarks that fail have an ERROR
+    message instead of times.
+    Optional arguments:
+      SIZES - List of names of sizes in SIZES, or a dict mapping names to
+              parameters for SYNTHETIC.MAKE_SBEMDB
+      OFN - Name of a JSON file to which the results are written
+      ONLY - List of names of benchmarks to run; default is all
+      WORKDIR - Directory for the database files; default is a temporary
+                directory that is removed afterwards
+      VERBOSE - Print progress'''
+    if sizes is None:
+        sizes = ['small', 'medium']
+    if not isinstance(sizes, dict):
+        sizes = { name: SIZES[name] for name in sizes }
+    results = []
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory())
+        for name, params in sizes.items():
+            dbfn = os.path.join(workdir, f'bench_{name}.sbemdb')
+            counts = synthetic.make_sbemdb(dbfn, **params)
+            db = sbemdb.SBEMDB(dbfn)
+            ctx = Context(db)
+            if verbose:
+                print(f'{name}: {counts["nodes"]} nodes, '
+                      + f'{counts["synapses"]} synapses')
+            for bname, fn in BENCHMARKS:
+                if only is not None and bname not in only:
+                    continue
+                res = { 'size': name, 'params': params, 'counts': counts,
+                        'benchmark': bname }
+                try:
+                    times = _time(fn, db, ctx, repeat)
+                    res['times'] = times
+                    res['best'] = min(times)
+                    res['median'] = float(np.median(times))
+                    if verbose:
+                        print(f'  {bname:28s} {res["best"]*1e3:10.2f} ms')
+                except Exception as e:
+                    res['error'] = f'{type(e).__name__}: {e}'
+                    if verbose:
+                        print(f'  {bname:28s} {res["error"]}')
+                results.append(res)
+            db.db.close()
+    out = { 'environment': environment(), 'results': results }
+    if ofn is not None:
+        with open(ofn, 'w') as fd:
+            json.dump(out, fd, indent=1)
+    return out
+
+def compare(old, new, threshold=1.2):
+    '''COMPARE - Compare two sets of benchmark results
+    rows = COMPARE(old, new) compares the BEST times of the benchmarks in
+    two results from RUN (or the names of JSON files containing them),
+    and returns a list of (size, benchmark, oldtime, newtime, ratio)
+    tuples, sorted by decreasing RATIO = NEWTIME / OLDTIME. Benchmarks
+    whose ratio exceeds THRESHOLD are also printed as regressions.'''
+    def load(res):
+        if isinstance(res, str):
+            with open(res) as fd:
+                res = json.load(fd)
+        return { (r['size'], r['benchmark']): r.get('best')
+                 for r in res['results'] }
+    old = load(old)
+    new = load(new)
+    rows = []
+    for key, t1 in new.items():
+        t0 = old.get(key)
+        if t0 is None or t1 is None:
+            continue
+        rows.append(key + (t0, t1, t1 / max(t0, 1e-9)))
+    rows.sort(key=lambda row: -row[-1])
+    for size, bname, t0, t1, ratio in rows:
+        if ratio > threshold:
+            print(f'Regression: {size} {bname}: {t0*1e3:.2f} ms'
+                  + f' -> {t1*1e3:.2f} ms ({ratio:.2f}x)')
+    return rows
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='Benchmark SBEMDB on synthetic databases')
+    p.add_argument('-o', '--output', default='bench.json',
+                   help='JSON file for the results')
+    p.add_argument('-s', '--sizes', default='small,medium',
+                   help='comma-separated sizes: ' + ','.join(SIZES))
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    p.add_argument('-b', '--benchmarks', default=None,
+                   help='comma-separated benchmark names; default is all')
+    p.add_argument('-c', '--compare', default=None,
+                   help='earlier JSON file to compare against')
+    args = p.parse_args()
+    only = args.benchmarks.split(',') if args.benchmarks else None
+    res = run(args.sizes.split(','), args.output, args.repeat, only)
+    if args.compare:
+        compare(args.compare, res)
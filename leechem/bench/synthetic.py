@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+import numpy as np
+import sqlite3
+import os
+
+SCHEMA = '''
+create table trees (tid integer primary key, tname text,
+                    cdate integer, uid integer);
+create table nodes (nid integer primary key, tid integer, typ integer,
+                    x integer, y integer, z integer,
+                    cdate integer, uid integer);
+create table nodecons (ncid integer primary key, nid1 integer, nid2 integer);
+create table synapses (sid integer primary key, cdate integer, uid integer);
+create table syncons (scid integer primary key, sid integer, nid integer);
+create table tags (tagid integer primary key, nid integer, tag text);
+create table nodetypes (typ integer primary key, descr text);
+'''
+
+NODETYPES = [ (1, 'Soma'), (2, 'Exit point'), (3, 'Tree node'),
+              (5, 'Presynaptic terminal'), (6, 'Postsynaptic terminal') ]
+
+def _positions(parent, step):
+    # Position of each node as the sum of the steps along the path from
+    # the root, computed by pointer jumping: after round k, ACC[i] holds
+    # the sum of the steps of the 2**k nearest ancestors of node i.
+    acc = step.copy()
+    anc = parent.copy()
+    while True:
+        up = anc >= 0
+        if not np.any(up):
+            return acc
+        acc[up] += acc[anc[up]]
+        nxt = anc.copy()
+        nxt[up] = anc[anc[up]]
+        anc = nxt
+
+def _tree(rng, nodes, branching, steplen):
+    # Parents and positions (relative to the soma) of the nodes of one
+    # tree. Node 0 is the soma, which has exactly one child, node 1. Each
+    # further node continues from the previous node, or, with probability
+    # BRANCHING, starts a new branch from a random earlier node.
+    k = np.arange(nodes)
+    parent = k - 1
+    branch = (rng.random(nodes) < branching) & (k >= 2)
+    parent[branch] = 1 + (rng.random(np.count_nonzero(branch))
+                          * (k[branch] - 1)).astype(int)
+    step = rng.integers(-steplen, steplen + 1, (nodes, 3))
+    step[0] = 0
+    return parent, _positions(parent, step)
+
+def make_sbemdb(fn, ntrees=20, nodes=400, branching=0.08, synapses=0.02,
+                tagged=0.1, extent=20000, steplen=100, seed=1):
+    '''MAKE_SBEMDB - Create a synthetic SBEMDB database
+    counts = MAKE_SBEMDB(fn) creates a database file with the same tables
+    as the published SBEMDB (trees, nodes, nodecons, synapses, syncons,
+    tags, and nodetypes), filled with random trees, and returns a dict
+    with the number of rows in each table. An existing file FN is
+    overwritten.
+    Optional arguments:
+      NTREES - Number of trees
+      NODES - Number of (regular) nodes per tree, including the soma
+      BRANCHING - Probability that a node starts a new branch rather than
+                  continuing the current one
+      SYNAPSES - Probability that a node has a presynaptic terminal. Each
+                 terminal is paired with a postsynaptic terminal on a
+                 random node of a random tree.
+      TAGGED - Fraction of synaptic terminals that get a certainty tag
+               of the kind read by CERTAINTIES
+      EXTENT - Size of the volume in which somata are placed, in pixels
+      STEPLEN - Maximum distance between adjacent nodes along each axis,
+                in pixels
+      SEED - Seed for the random number generator
+    As in the real database, every node connection is stored in both
+    directions, and coordinates are integers (pixels for x and y, slices
+    for z).'''
+    rng = np.random.default_rng(seed)
+    if os.path.exists(fn):
+        os.remove(fn)
+    con = sqlite3.connect(fn)
+    con.executescript(SCHEMA)
+    con.executemany('insert into nodetypes values (?, ?)', NODETYPES)
+    con.executemany('insert into trees values (?, ?, 0, 0)',
+                    [ (t, f'tree{t}') for t in range(1, ntrees + 1) ])
+
+    # Regular nodes, tree by tree, with consecutive node IDs
+    tids = []
+    parents = []
+    xyz = []
+    for t in range(ntrees):
+        parent, pos = _tree(rng, nodes, branching, steplen)
+        pos += rng.integers(0, extent, 3)
+        tids.append(np.full(nodes, t + 1))
+        parents.append(np.where(parent >= 0, parent + t*nodes, -1))
+        xyz.append(pos)
+    tids = np.concatenate(tids)
+    parents = np.concatenate(parents)
+    xyz = np.concatenate(xyz)
+    typ = np.where(np.arange(len(tids)) % nodes == 0, 1, 3)
+    N = len(tids)
+
+    # Synapses: a presynaptic terminal hanging off a random node, paired
+    # with a postsynaptic terminal hanging off a random node elsewhere
+    cand = np.nonzero(typ==3)[0]
+    pre = cand[rng.random(len(cand)) < synapses]
+    post = rng.choice(cand, len(pre)) if len(cand) else pre
+    S = len(pre)
+    hosts = np.concatenate((pre, post))
+    syntyp = np.concatenate((np.full(S, 5), np.full(S, 6)))
+    synxyz = xyz[hosts] + rng.integers(-steplen//2, steplen//2 + 1, (2*S, 3))
+
+    tids = np.concatenate((tids, tids[hosts]))
+    typ = np.concatenate((typ, syntyp))
+    xyz = np.concatenate((xyz, synxyz))
+    parents = np.concatenate((parents, hosts))
+    nids = np.arange(1, len(tids) + 1)
+
+    con.executemany('insert into nodes values (?, ?, ?, ?, ?, ?, 0, 0)',
+                    zip(nids.tolist(), tids.tolist(), typ.tolist(),
+                        xyz[:,0].tolist(), xyz[:,1].tolist(),
+                        xyz[:,2].tolist()))
+    child = np.nonzero(parents >= 0)[0]
+    a = nids[parents[child]].tolist()
+    b = nids[child].tolist()
+    con.executemany('insert into nodecons (nid1, nid2) values (?, ?)',
+                    [ ab for pair in zip(zip(a, b), zip(b, a))
+                      for ab in pair ])
+    sids = np.arange(1, S + 1)
+    con.executemany('insert into synapses values (?, 0, 0)',
+                    [ (s,) for s in sids.tolist() ])
+    con.executemany('insert into syncons (sid, nid) values (?, ?)',
+                    zip(np.concatenate((sids, sids)).tolist(),
+                        nids[N:].tolist()))
+    tagme = nids[N:][rng.random(2*S) < tagged]
+    con.executemany('insert into tags (nid, tag) values (?, ?)',
+                    [ (n, f'b:{rng.integers(1, 101)}; s:{rng.integers(1, 4)}')
+                      for n in tagme.tolist() ])
+    con.commit()
+    counts = {}
+    for table in ['trees', 'nodes', 'nodecons', 'synapses', 'syncons',
+                  'tags', 'nodetypes']:
+        counts[table] = con.execute(f'select count(*) from {table}').fetchone()[0]
+    con.close()
+    return counts
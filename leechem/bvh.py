@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+import numpy as np
+from . import sbemdb
+
+class SegmentBVH:
+    '''SEGMENTBVH - Bounding volume hierarchy over line segments
+
+    bvh = SEGMENTBVH(p1, p2, labels, ids) builds a tree of axis-aligned
+    bounding boxes over the line segments from P1[k] to P2[k], where
+    P1 and P2 are Kx3 arrays. LABELS is an optional array of K integers
+    that can be used to exclude groups of segments from queries. IDS is
+    an optional array of K integers identifying the segments (e.g., the
+    "ncid" of the corresponding node connection); it defaults to the
+    index of the segments. Both LABELS and IDS may be modified after
+    construction, but P1 and P2 may not.
+
+    The hierarchy is stored in flat arrays: for each box, LO and HI are
+    its corners, LEFT and RIGHT its children (or -1 for a leaf), and for
+    leaves, START and END delimit its segments in ORDER.'''
+    def __init__(self, p1, p2, labels=None, ids=None, leafsize=8):
+        self.p1 = np.asarray(p1, dtype=float).reshape(-1, 3)
+        self.p2 = np.asarray(p2, dtype=float).reshape(-1, 3)
+        K = len(self.p1)
+        if labels is None:
+            labels = np.zeros(K, dtype=int)
+        if ids is None:
+            ids = np.arange(K)
+        self.labels = np.array(labels, dtype=int)
+        self.ids = np.array(ids, dtype=int)
+
+        lo = np.minimum(self.p1, self.p2)
+        hi = np.maximum(self.p1, self.p2)
+        ctr = (lo + hi) / 2
+        order = np.arange(K)
+        boxes = [] # (lo, hi, left, right, start, end)
+        stack = [(0, K, -1, 0)] # (start, end, parentbox, side)
+        while stack:
+            k0, k1, par, side = stack.pop()
+            idx = order[k0:k1]
+            me = len(boxes)
+            if K:
+                boxes.append([np.min(lo[idx], 0), np.max(hi[idx], 0),
+                              -1, -1, k0, k1])
+            else:
+                boxes.append([np.zeros(3), np.zeros(3), -1, -1, 0, 0])
+            if par >= 0:
+                boxes[par][2 + side] = me
+            if k1 - k0 > leafsize:
+                c = ctr[idx]
+                ax = np.argmax(np.max(c, 0) - np.min(c, 0))
+                srt = np.argsort(c[:,ax], kind='stable')
+                order[k0:k1] = idx[srt]
+                mid = (k0 + k1) // 2
+                stack.append((mid, k1, me, 1))
+                stack.append((k0, mid, me, 0))
+        self.order = order
+        self.lo = np.array([b[0] for b in boxes]).reshape(-1, 3)
+        self.hi = np.array([b[1] for b in boxes]).reshape(-1, 3)
+        self.left = [b[2] for b in boxes]
+        self.right = [b[3] for b in boxes]
+        self.start = [b[4] for b in boxes]
+        self.end = [b[5] for b in boxes]
+
+    def _boxdist(self, p, b):
+        gap = np.maximum(np.maximum(self.lo[b] - p, p - self.hi[b]), 0)
+        return np.sqrt(np.sum(gap**2, -1))
+
+    def nearest(self, p, exclude=None, labels=None):
+        '''NEAREST - Segment nearest to a point
+        (dist, id) = NEAREST(p, exclude) returns the distance between the
+        point P and the nearest segment, and the ID of that segment.
+        Segments with label EXCLUDE are ignored. Ties are broken in favor
+        of the lowest ID. If no segments remain, returns (inf, None).
+        Optional argument LABELS is an array of K labels to use instead of
+        those stored in the BVH. Since the BVH itself is not modified,
+        several users that label the segments differently can then share
+        it, even from several threads.'''
+        p = np.asarray(p, dtype=float)
+        if labels is None:
+            labels = self.labels
+        best = np.inf
+        bestid = None
+        if len(self.order)==0:
+            return best, bestid
+        stack = [(0.0, 0)]
+        while stack:
+            bd, b = stack.pop()
+            if bd > best:
+                continue
+            if self.left[b] < 0:
+                idx = self.order[self.start[b]:self.end[b]]
+                if exclude is not None:
+                    idx = idx[labels[idx] != exclude]
+                if len(idx)==0:
+                    continue
+                dd = sbemdb.LineSegmentGeom.pointDistances(p, self.p1[idx],
+                                                           self.p2[idx])[0]
+                k = np.argmin(dd)
+                d = dd[k]
+                if d <= best:
+                    ids = self.ids[idx[dd==d]]
+                    i = np.min(ids)
+                    if d < best or i < bestid:
+                        best = d
+                        bestid = i
+            else:
+                kids = [self.left[b], self.right[b]]
+                kd = self._boxdist(p, kids)
+                # Push the farther child first, so that the nearer one is
+                # explored first
+                if kd[0] < kd[1]:
+                    stack.append((kd[1], kids[1]))
+                    stack.append((kd[0], kids[0]))
+                else:
+                    stack.append((kd[0], kids[0]))
+                    stack.append((kd[1], kids[1]))
+        if bestid is None:
+            return best, None
+        return float(best), int(bestid)
+
+    def nearestMany(self, pp, exclude=None, labels=None):
+        '''NEARESTMANY - Segments nearest to many points
+        (dists, ids) = NEARESTMANY(pp, exclude), where PP is an Nx3 array,
+        returns the results of NEAREST for each of the points as arrays.
+        EXCLUDE may be a single label or an array of N labels, one for
+        each point. Where no segment is found, the ID is -1. LABELS is as
+        for NEAREST.'''
+        pp = np.asarray(pp, dtype=float).reshape(-1, 3)
+        N = len(pp)
+        if exclude is None or np.isscalar(exclude):
+            exclude = [exclude] * N
+        dists = np.zeros(N)
+        ids = np.zeros(N, dtype=int)
+        for n in range(N):
+            d, i = self.nearest(pp[n], exclude[n], labels)
+            dists[n] = d
+            ids[n] = -1 if i is None else i
+        return dists, ids
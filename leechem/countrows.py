@@ -2,6 +2,4 @@ def count_rows(table, db, before=True):
     # helper function printing number of rows in a table
     if before: text='Before'
     else: text='After'
-    c = db.db.cursor()
-    c.execute(f'select * from {table}')
-    print(table, text, len(c.fetchall()))
+    print(table, text, db.rowcounts([table])[table])
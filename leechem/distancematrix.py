@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import numpy as np
+from .query import Filter
+
+def synapse_centers(db, post_tid=444, where=''):
+    '''SYNAPSE_CENTERS - Synapses onto a tree and their offsets
+    (sids, postnids, offsets) = SYNAPSE_CENTERS(db, post_tid, where)
+    returns the IDs of all synapses onto the given postsynaptic tree that
+    match the given WHERE clause (as for SBEMDB.SYNAPSES), the IDs of their
+    postsynaptic nodes, and the distances (in microns) between those nodes
+    and the centers of the synapses. Each synapse is listed only once; if
+    the database contains more than one pair of presynaptic and
+    postsynaptic nodes for a synapse, the last pair wins, as in the
+    clustering notebook.
+    WHERE may also be a FILTER (see the query module).'''
+    if isinstance(where, Filter):
+        clause = Filter(posttid=post_tid) & where
+    else:
+        clause = f'post.tid={int(post_tid)}'
+        if where != '':
+            clause += f' and ({where})'
+    syn = db.synapses(clause, extended=True, asrecord=True)
+    # Keep the last occurrence of each synapse ID
+    sids, last = np.unique(syn.sid[::-1], return_index=True)
+    syn = syn[len(syn) - 1 - last]
+    idx = db.treeIndex(post_tid)
+    xyz = idx.xyz[idx.local(syn.postnid)]
+    offsets = np.sqrt((syn.x - xyz[:,0])**2
+                      + (syn.y - xyz[:,1])**2
+                      + (syn.z - xyz[:,2])**2)
+    return syn.sid, syn.postnid, offsets
+
+def synapse_distance_matrix(db, post_tid=444, where='', condensed=False,
+                            ofn=None, chunk=1024):
+    '''SYNAPSE_DISTANCE_MATRIX - Distances along a tree between synapses
+    mat = SYNAPSE_DISTANCE_MATRIX(db, post_tid, where) returns a matrix
+    of distances (in microns) between all the synapses onto the given
+    postsynaptic tree that match the given WHERE clause (see
+    SYNAPSE_CENTERS). The distance between two synapses is the length of
+    the path along the postsynaptic tree between their postsynaptic
+    nodes, plus the distance from each of those nodes to the center of
+    its synapse, just like FINDPATH.FIND_PATH computes it.
+    The first row and first column of MAT contain the synapse IDs, so
+    that MAT is an (N+1)x(N+1) matrix for N synapses, in the format used
+    by NN_CLUSTERING.MATRIXSYNAPSEDISTANCE. (MAT[0,0] is zero.)
+    (sids, dd) = SYNAPSE_DISTANCE_MATRIX(..., condensed=True) instead
+    returns the synapse IDs separately, and the distances as a condensed
+    vector of length N(N-1)/2 containing the upper triangle of the
+    matrix row by row (as for scipy.spatial.distance.squareform).
+    Optional argument OFN names an .npy file to which the result is
+    written through a memory map; the memory-mapped array is then
+    returned.
+    The matrix is computed CHUNK rows at a time, using the
+    constant-time path distances of SBEMDB.TREEINDEX, so that memory
+    use beyond the result itself stays bounded.'''
+    sids, postnids, offsets = synapse_centers(db, post_tid, where)
+    idx = db.treeIndex(post_tid)
+    ii = idx.local(postnids)
+    N = len(sids)
+
+    if condensed:
+        shape = (N*(N-1)//2,)
+    else:
+        shape = (N+1, N+1)
+    if ofn is None:
+        out = np.zeros(shape)
+    else:
+        out = np.lib.format.open_memmap(ofn, mode='w+', dtype=float,
+                                        shape=shape)
+
+    if not condensed:
+        out[0,0] = 0
+        out[0,1:] = sids
+        out[1:,0] = sids
+    for k0 in range(0, N, chunk):
+        k1 = min(k0 + chunk, N)
+        dd = idx.localDistances(ii[k0:k1,None], ii[None,:])
+        dd += offsets[k0:k1,None] + offsets[None,:]
+        dd[np.arange(k1-k0), np.arange(k0, k1)] = 0
+        if condensed:
+            for k in range(k0, k1):
+                start = k*N - k*(k+1)//2
+                out[start:start + N - k - 1] = dd[k-k0, k+1:]
+        else:
+            out[k0+1:k1+1, 1:] = dd
+    if ofn is not None:
+        out.flush()
+    if condensed:
+        return sids, out
+    return out
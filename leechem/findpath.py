@@ -1,6 +1,84 @@
-from distance import distance;
+import collections;
+import os;
+import threading;
 import warnings;
-import networkx as nx;
+import weakref;
+import numpy as np;
+from .distance import distance;
+from .query import Filter;
+
+# Maximum total number of nodes in the trees held by GRAPHS
+MAXNODES = 2000000
+
+class GraphCache:
+    '''GRAPHCACHE - Least-recently-used cache of tree graphs
+
+    gc = GRAPHCACHE(maxnodes) creates an empty cache of TREEINDEX objects
+    (see the treeindex module), which hold the coordinates and the
+    parent, depth, and distance-to-root of each node of a tree. Trees are
+    keyed by the name of their database file, its FINGERPRINT, and their
+    tree ID, so that several SBEMDB objects on the same file share them
+    and a changed file is never served from stale entries. When the total
+    number of nodes would exceed MAXNODES, the least recently used trees
+    are evicted.
+    The indices are those of SBEMDB.TREEINDEX, so a tree is built only
+    once for both; an evicted index is also dropped from the SBEMDB that
+    built it.'''
+    def __init__(self, maxnodes):
+        self.maxnodes = maxnodes
+        self.entries = collections.OrderedDict() # key -> (TreeIndex, db ref)
+        self.nnodes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, db, tid):
+        '''GET - Graph for a tree
+        idx = GET(db, tid) returns the TREEINDEX for the given tree in the
+        given SBEMDB, building it if it is not in the cache.'''
+        name = db.dbfn if db.path is None else os.path.abspath(db.path)
+        key = (name, tuple(sorted(db.fingerprint().items())), tid)
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return ent[0]
+            self.misses += 1
+        idx = db.treeIndex(tid)
+        n = len(idx.nids)
+        with self.lock:
+            if key not in self.entries and n <= self.maxnodes:
+                while self.entries and self.nnodes + n > self.maxnodes:
+                    (_, _, oldtid), (old, ref) = self.entries.popitem(last=False)
+                    self.nnodes -= len(old.nids)
+                    self.evictions += 1
+                    owner = ref()
+                    if owner is not None and owner.indices.get(oldtid) is old:
+                        del owner.indices[oldtid]
+                self.entries[key] = (idx, weakref.ref(db))
+                self.nnodes += n
+        return idx
+
+    def clear(self):
+        '''CLEAR - Forget all trees'''
+        with self.lock:
+            self.entries.clear()
+            self.nnodes = 0
+
+    def stats(self):
+        '''STATS - Usage statistics
+        STATS() returns a dict with the number of HITS, MISSES, and
+        EVICTIONS so far, as well as the current number of TREES and their
+        total number of NODES.'''
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses,
+                     'evictions': self.evictions,
+                     'trees': len(self.entries), 'nodes': self.nnodes,
+                     'maxnodes': self.maxnodes }
+
+GRAPHS = GraphCache(MAXNODES)
 
 def find_path(db, nid1, nid2):
     '''
@@ -9,52 +87,67 @@ def find_path(db, nid1, nid2):
     If one/both nodes are pre/post-synaptic add distance from the node(s) to the middle of the synapse(s) they belong to
         to the total distance
     '''
-    if nid1 == nid2:
-        raise ValueError('Node ids have to be different')
-        
-    nodes = db.nodeDetails(f'nid={nid1} or nid={nid2}')
-    if nid1 not in nodes or nid2 not in nodes:
+    return find_paths(db, [(nid1, nid2)])[0]
+
+def find_paths(db, pairs):
+    '''
+    Like FIND_PATH, but for many pairs of nodes at once.
+    PAIRS is a list of (nid1, nid2) tuples. Returns a list of (length, path)
+    tuples in the same order.
+    Pairs are grouped by tree, and all pairs on a tree are answered from a
+    single graph taken from GRAPHS, which keeps graphs between calls.
+    '''
+    pairs = [ (int(nid1), int(nid2)) for nid1, nid2 in pairs ]
+    for nid1, nid2 in pairs:
+        if nid1 == nid2:
+            raise ValueError('Node ids have to be different')
+    if len(pairs) == 0:
+        return []
+
+    nids = sorted(set(nid for pair in pairs for nid in pair))
+    try:
+        nodes = dict(zip(nids, db.nodeDetailsMany(nids)))
+    except ValueError:
         raise ValueError('One/both nodes are not in the database')
-        
-    tid1 = nodes[nid1].tid
-    tid2 = nodes[nid2].tid
-    if tid1 != tid2:
-        raise ValueError('Nodes are on different trees')
-        
-    typ1 = nodes[nid1].typ
-    typ2 = nodes[nid2].typ
-        
-    x, y, z, nids = db.nodexyz(f'tid={tid1}')
-    # nodes' coordinates map
-    node_coords = {}
-    for i, nid in enumerate(nids):
-        node_coords[nid] = [x[i], y[i], z[i]]
-        
-    # add distance to the center of synapse
-    add_to_length = 0
-    if typ1 in [5, 6]: # is synapse (5 - pre, 6-post synaptic)
-        (xx, yy, zz, pretid, posttid) = db.synapses(f'a.nid={nid1} or b.nid={nid1}')
-        if len(xx) == 0: warnings.warn(f'Synapse node {nid1} is connected to a tree, which is not on the list of available trees.')
-        else: add_to_length += distance(xx[0], yy[0], zz[0], *(node_coords[nid1]))
-    if typ2 in [5, 6]: # is synapse (5 - pre, 6-post synaptic)
-        (xx, yy, zz, pretid, posttid) = db.synapses(f'a.nid={nid2} or b.nid={nid2}')
-        if len(xx) == 0: warnings.warn(f'Synapse node {nid2} is connected to a tree, which is not on the list of available trees.')
-        else: add_to_length += distance(xx[0], yy[0], zz[0], *(node_coords[nid2]))
-    
-    c = db.db.cursor()
-    c.execute(f'select c.nid1, c.nid2' +
-              f' from nodes inner join nodecons as c on nodes.nid==c.nid1 inner join nodes as b on c.nid2==b.nid' +
-              f' where nodes.tid={tid1} and b.tid={tid1}')
-    # create graph
-    G = nx.DiGraph()
-    for row in c.fetchall():
-        G_nid1, G_nid2 = row[0], row[1]
-        G.add_edge(G_nid1, G_nid2, distance=distance(*(node_coords[G_nid1] + node_coords[G_nid2])))
-        
-    length = nx.dijkstra_path_length(G, nid1, nid2, 'distance')
-    length += add_to_length
-    path = nx.dijkstra_path(G, nid1, nid2, 'distance')
-    return length, path
+    bytree = {}
+    for k, (nid1, nid2) in enumerate(pairs):
+        tid1 = nodes[nid1].tid
+        tid2 = nodes[nid2].tid
+        if tid1 != tid2:
+            raise ValueError('Nodes are on different trees')
+        bytree.setdefault(tid1, []).append(k)
+
+    # centers of the synapses of synaptic nodes
+    centers = {}
+    syn = [ nid for nid in nids if nodes[nid].typ in [5, 6] ] # 5 - pre, 6-post synaptic
+    synset = set(syn)
+    if syn:
+        for where in [Filter(prenid=syn), Filter(postnid=syn)]:
+            (xx, yy, zz, pretid, posttid, synid, prenid, postnid) \
+                = db.synapses(where, True)
+            for i in range(len(xx)):
+                for nid in [prenid[i], postnid[i]]:
+                    if nid in synset and nid not in centers:
+                        centers[nid] = (xx[i], yy[i], zz[i])
+
+    results = [None] * len(pairs)
+    for tid, ks in bytree.items():
+        idx = GRAPHS.get(db, tid)
+        ii = idx.local([pairs[k][0] for k in ks])
+        jj = idx.local([pairs[k][1] for k in ks])
+        lengths = idx.localDistances(ii, jj)
+        for k, i, j, length in zip(ks, ii, jj, lengths):
+            nid1, nid2 = pairs[k]
+            # add distance to the center of synapse
+            for nid, n in [(nid1, i), (nid2, j)]:
+                if nodes[nid].typ in [5, 6]:
+                    if nid not in centers:
+                        warnings.warn(f'Synapse node {nid} is connected to a tree, which is not on the list of available trees.')
+                    else:
+                        length += distance(*centers[nid], *idx.xyz[n])
+            path = idx.path(nid1, nid2)
+            results[k] = (length, path)
+    return results
     
 def find_path_ext(db, pre_tid=None, post_tid=None):
     '''
@@ -62,61 +155,43 @@ def find_path_ext(db, pre_tid=None, post_tid=None):
     Returns maps in the following forms:
         1) {(pre_tid, post_tid): {synapse_id: distance}} # distance is from synapse to post_tree's soma
         2) {(pre_tid, post_tid): {synapse_id: [path]}}   # path are nodes
+    Distances are read off the graph of each postsynaptic tree in GRAPHS,
+    which is built with a single traversal from the soma, so that each synapse takes constant time rather than a search
+    of the whole tree.
     '''
-    where1 = ''
-    where2 = ''
-    where3 = ''
-    where4 = 'typ=1'
+    synfilter = Filter()
+    somafilter = Filter(typ=1)
     if pre_tid is not None:
-        where1 += f'pre.tid={pre_tid}'
-        where2 += f'tid={pre_tid}'
-        where3 += f'where nodes.tid={pre_tid} or b.tid={pre_tid}'
+        synfilter &= Filter(pretid=pre_tid)
     if post_tid is not None:
-        if where1 != '':
-            where1 += f' and post.tid={post_tid}'
-        else:
-            where1 += f'post.tid={post_tid}'
-
-        if where2 != '':
-            where2 += f' or tid={post_tid}'
-        else:
-            where2 += f'tid={post_tid}'
-
-        if where3 != '':
-            where3 += f' or nodes.tid={post_tid} or b.tid={post_tid}'
-        else:
-            where3 += f'where nodes.tid={post_tid} or b.tid={post_tid}'
-
-        if where4 != '':
-            where4 += f' and tid={post_tid}'
-
-    x, y, z, nids = db.nodexyz(where2)
-    # nodes' coordinates map
-    node_coords = {}
-    for i, nid in enumerate(nids):
-        node_coords[nid] = [x[i], y[i], z[i]]
-
-
-    select_subject = 'c.nid1, c.nid2'
-    from_tables = 'nodes inner join nodecons as c on nodes.nid==c.nid1 inner join nodes as b on c.nid2==b.nid'
-    c = db.db.cursor()
-    c.execute(f'select {select_subject}'
-              f' from {from_tables} {where3}')
-    # create graph
-    G = nx.DiGraph()
-    for row in c.fetchall():
-        G_nid1, G_nid2 = row[0], row[1]                
-        G.add_edge(G_nid1, G_nid2, distance=distance(*(node_coords[G_nid1] + node_coords[G_nid2])))
+        synfilter &= Filter(posttid=post_tid)
+        somafilter &= Filter(tid=post_tid)
 
     # get targets(somas) nids
     treeid2nid = {}
-    data = db.nodeDetails(where4)
+    data = db.nodeDetails(somafilter)
     for nid in data:
         tid = data[nid].tid
         treeid2nid[tid] = nid
 
     # get synapses 
-    xx, yy, zz, pretid, posttid, synid, prenid, postnid = db.synapses(where1, extended=True)
+    xx, yy, zz, pretid, posttid, synid, prenid, postnid = db.synapses(synfilter, extended=True)
+
+    # distances from each synapse to the soma of its postsynaptic tree,
+    # one tree at a time
+    lengths = np.zeros(len(synid))
+    graphs = {}
+    for tid in np.unique(posttid):
+        if tid not in treeid2nid:
+            continue
+        mine = np.nonzero(posttid==tid)[0]
+        idx = graphs[tid] = GRAPHS.get(db, tid)
+        ii = idx.local(postnid[mine])
+        soma = idx.local(treeid2nid[tid])
+        lengths[mine] = idx.localDistances(ii, soma)
+        lengths[mine] += np.sqrt((xx[mine] - idx.xyz[ii,0])**2
+                                 + (yy[mine] - idx.xyz[ii,1])**2
+                                 + (zz[mine] - idx.xyz[ii,2])**2)
 
     # calculations
     results_length = {} # {(source_tree_id, target_tree_id): {synapse_id: distance}}
@@ -130,13 +205,11 @@ def find_path_ext(db, pre_tid=None, post_tid=None):
             results_length[(pre_tid, post_tid)] = {}
             results_path[(pre_tid, post_tid)] = {}
         if post_tid in treeid2nid: # if has soma
-            length = nx.dijkstra_path_length(G, post_nid, treeid2nid[post_tid], 'distance')
-            length += distance(xx[i], yy[i], zz[i], *node_coords[post_nid])
-            path = nx.dijkstra_path(G, post_nid, treeid2nid[post_tid], 'distance')
-            results_length[(pre_tid, post_tid)][syn_id] = length
+            path = graphs[post_tid].path(post_nid, treeid2nid[post_tid])
+            results_length[(pre_tid, post_tid)][syn_id] = lengths[i]
             results_path[(pre_tid, post_tid)][syn_id] = path
         else:
             results_length[(pre_tid, post_tid)][syn_id] = 'Target tree has no soma'
             results_path[(pre_tid, post_tid)][syn_id] = 'Target tree has no soma'
 
-    return results_length, results_path
\ No newline at end of file
+    return results_length, results_path
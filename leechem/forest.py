@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import numpy as np
+import concurrent.futures
+import contextlib
+import io
+import os
+import time
+from . import sbemdb
+from . import tree
+from .query import Filter
+
+# The database of a worker process, opened by _INITWORKER
+_db = None
+
+# Fields of TABLE, for a forest without trees
+_EMPTYDTYPE = [('tid', int), ('rootnid', int), ('sid', int), ('parent', int),
+               ('depth', int), ('nchildren', int), ('nedges', int),
+               ('pathlen', float), ('hassyn', bool), ('firstnid', int),
+               ('lastnid', int), ('neighbor_dist', float),
+               ('skeleton_dist', float), ('skeleton_ncid', int)]
+
+def _initworker(dbfn, snapcache):
+    # SNAPCACHE is the SNAPCACHE of the parent's database, or None if it
+    # has no snapshot
+    global _db
+    _db = sbemdb.SBEMDB(dbfn, readonly=True)
+    if snapcache is not None:
+        _db.snapshot(cache=bool(snapcache), hashcontent=(snapcache=='hash'))
+
+def _buildtree(db, rootnid):
+    # Build one tree, silencing its progress messages. Returns (tree,
+    # seconds) or (error message, seconds).
+    t0 = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = tree.Tree(rootnid, db)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}', time.perf_counter() - t0
+    return t, time.perf_counter() - t0
+
+def _workertree(rootnid):
+    t, dt = _buildtree(_db, rootnid)
+    if not isinstance(t, str):
+        t.bvh = None # rebuilt on demand; not worth shipping between processes
+    return t, dt
+
+class Forest(dict):
+    '''FOREST - Trees for many root nodes
+
+    forest = FOREST(db) builds a TREE (see the tree module) from each soma
+    in the given SBEMDB. FOREST is a dict mapping root node IDs to trees.
+    forest = FOREST(db, rootnids) builds trees from the given nodes
+    instead.
+    Optional arguments:
+      WORKERS - Number of worker processes. Default is one per CPU. If
+                zero, trees are built in the calling process.
+      VERBOSE - Print the time taken by each tree as it completes.
+    Each worker process opens the database file for itself, read-only,
+    so this does not work for in-memory databases; those are always built
+    in the calling process. If DB has a snapshot loaded, each worker loads
+    one too, using the sidecar cache only if DB's snapshot did (see
+    SBEMDB.SNAPSHOT).
+    Trees that cannot be built are left out; their error messages are in
+    ERRORS, a dict mapping root node IDs to messages. TIMES maps root node
+    IDs to the time (in seconds) taken to build each tree, and ELAPSED is
+    the total wall time.
+    TABLE combines the segment tables of all trees.'''
+    def __init__(self, db, rootnids=None, workers=None, verbose=True):
+        if rootnids is None:
+            rootnids = db.nodexyz(Filter(typ=1))[3]
+        rootnids = [ int(nid) for nid in rootnids ]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if db.memory:
+            workers = 0
+        self.times = {}
+        self.errors = {}
+        t0 = time.perf_counter()
+        results = {}
+        N = len(rootnids)
+
+        def report(rootnid, res, dt):
+            self.times[rootnid] = dt
+            if isinstance(res, str):
+                self.errors[rootnid] = res
+            else:
+                results[rootnid] = res
+            if verbose:
+                if isinstance(res, str):
+                    what = res
+                else:
+                    what = f'tree {res.tid}, {len(res)} segments'
+                print(f'[{len(self.times)}/{N}] root {rootnid}: {what}'
+                      + f' in {dt:.2f} s')
+
+        if workers==0 or N<=1:
+            for rootnid in rootnids:
+                report(rootnid, *_buildtree(db, rootnid))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    min(workers, N), initializer=_initworker,
+                    initargs=(db.dbfn, None if db.snap is None
+                              else db.snapcache)) as pool:
+                futs = { pool.submit(_workertree, rootnid): rootnid
+                         for rootnid in rootnids }
+                for fut in concurrent.futures.as_completed(futs):
+                    report(futs[fut], *fut.result())
+        self.elapsed = time.perf_counter() - t0
+        for rootnid in rootnids:
+            if rootnid in results:
+                self[rootnid] = results[rootnid]
+        if verbose:
+            print(f'Built {len(self)} trees in {self.elapsed:.2f} s'
+                  + f' ({sum(self.times.values()):.2f} s of work)')
+
+    def table(self):
+        '''TABLE - Segments of all trees as a record array
+        rec = TABLE() returns a record array with the fields of TREE.TABLE
+        plus TID and ROOTNID, with the segments of each tree in turn.'''
+        parts = [ (np.full(len(tbl), t.tid), np.full(len(tbl), rootnid), tbl)
+                  for rootnid, t in self.items() for tbl in [t.table()] ]
+        if not parts:
+            return np.rec.array(np.zeros(0, dtype=_EMPTYDTYPE))
+        tbl = np.concatenate([ p[2] for p in parts ])
+        names = tbl.dtype.names
+        return np.rec.fromarrays([ np.concatenate([ p[0] for p in parts ]),
+                                   np.concatenate([ p[1] for p in parts ]) ]
+                                 + [ tbl[n] for n in names ],
+                                 names=['tid', 'rootnid'] + list(names))
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import contextlib
+import queue
+import threading
+
+class ConnectionPool:
+    '''CONNECTIONPOOL - Bounded pool of database connections
+
+    pool = CONNECTIONPOOL(connect, maxsize) creates a pool that hands out
+    at most MAXSIZE connections at any one time. Connections are created
+    on demand by calling CONNECT() and are reused once they have been
+    returned to the pool. A thread that asks for a connection while all
+    MAXSIZE are in use waits until one is returned.
+
+    Connections must be created with check_same_thread=False, since a
+    connection may be used by different threads in turn (but never by
+    two threads at once).'''
+    def __init__(self, connect, maxsize):
+        if maxsize < 1:
+            raise ValueError('Pool size must be at least 1')
+        self.connect = connect
+        self.maxsize = maxsize
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self, timeout=None):
+        '''ACQUIRE - Take a connection from the pool
+        con = ACQUIRE() returns an idle connection, creating one if there
+        are fewer than MAXSIZE. If all are in use, waits until one is
+        released, or at most TIMEOUT seconds, after which it raises
+        TimeoutError.'''
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError('No database connection available')
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            con = self.connect()
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.created += 1
+        return con
+
+    def release(self, con):
+        '''RELEASE - Return a connection to the pool'''
+        self.idle.put(con)
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        '''CONNECTION - Borrow a connection
+        with pool.CONNECTION() as con: ... uses a connection from the pool
+        for the duration of the block.'''
+        con = self.acquire(timeout)
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close(self):
+        '''CLOSE - Close all idle connections
+        Connections that are in use when CLOSE is called are closed when
+        they are garbage collected.'''
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import re
+import threading
+
+_STRING = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_NUMBER = re.compile(r'(?<!\?)\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b')
+_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def normalize(query):
+    '''NORMALIZE - Reduce an SQL statement to its shape
+    s = NORMALIZE(query) returns QUERY with whitespace collapsed, and with
+    string and numeric literals as well as lists of placeholders replaced
+    by a single "?", so that statements that differ only in their values
+    (whether bound or spliced into the text) normalize to the same
+    string.'''
+    query = ' '.join(query.split())
+    query = _STRING.sub('?', query)
+    query = _NUMBER.sub('?', query)
+    return _LIST.sub('?', query)
+
+class Profiler:
+    '''PROFILER - Record of the SQL statements executed by an SBEMDB
+
+    prof = PROFILER() creates an empty record. Pass its RECORD method to
+    SBEMDB.ADDHOOK, or, more conveniently, use
+
+      with db.profile() as prof:
+          ...
+
+    after which PROF.REPORT() prints a table of the statements that took
+    the most time.
+    Each call of RECORD appends a dict with the raw SQL, its NORMALIZED
+    form, the bound PARAMS, the wall time in SECONDS, the number of ROWS
+    returned, and the number of BYTES those rows occupy to ENTRIES.'''
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, query, params, seconds, rows, nbytes):
+        '''RECORD - Hook function for SBEMDB.ADDHOOK'''
+        if query.lstrip()[:7].lower() == 'explain':
+            return
+        with self.lock:
+            self.entries.append({ 'sql': query, 'normalized': normalize(query),
+                                  'params': params, 'seconds': seconds,
+                                  'rows': rows, 'bytes': nbytes })
+
+    def summary(self):
+        '''SUMMARY - Statistics per statement shape
+        rows = SUMMARY() returns a list of dicts, one for each distinct
+        NORMALIZED statement, with the number of CALLS, the TOTAL, MEAN,
+        and MAX time in seconds, the total number of ROWS and BYTES, and
+        the entry with the longest time (SLOWEST). The list is sorted by
+        decreasing TOTAL time.'''
+        groups = {}
+        with self.lock:
+            entries = list(self.entries)
+        for ent in entries:
+            grp = groups.get(ent['normalized'])
+            if grp is None:
+                grp = groups[ent['normalized']] = {
+                    'normalized': ent['normalized'], 'calls': 0,
+                    'total': 0.0, 'max': 0.0, 'rows': 0, 'bytes': 0,
+                    'slowest': ent }
+            grp['calls'] += 1
+            grp['total'] += ent['seconds']
+            grp['rows'] += ent['rows']
+            grp['bytes'] += ent['bytes']
+            if ent['seconds'] >= grp['max']:
+                grp['max'] = ent['seconds']
+                grp['slowest'] = ent
+        res = list(groups.values())
+        for grp in res:
+            grp['mean'] = grp['total'] / grp['calls']
+        res.sort(key=lambda grp: -grp['total'])
+        return res
+
+    def explain(self, db, top=3):
+        '''EXPLAIN - Query plans of the most expensive statements
+        plans = EXPLAIN(db, top) returns a list of (normalized, plan)
+        pairs for the TOP statement shapes with the largest total time,
+        where PLAN is the QUERYPLAN (see SBEMDB) of the slowest instance
+        of each, using its actual parameters.'''
+        res = []
+        for grp in self.summary()[:top]:
+            ent = grp['slowest']
+            try:
+                plan = db.queryplan(ent['sql'], ent['params'])
+            except Exception as e:
+                plan = [f'(no plan: {e})']
+            res.append((grp['normalized'], plan))
+        return res
+
+    def table(self, top=20, width=60):
+        '''TABLE - Ranked summary as text
+        s = TABLE(top) returns a table of the TOP statement shapes with the
+        largest total time, as from SUMMARY.'''
+        lines = [ f'{"calls":>6s} {"total ms":>10s} {"mean ms":>9s}'
+                  + f' {"max ms":>9s} {"rows":>9s} {"MB":>8s}  sql' ]
+        for grp in self.summary()[:top]:
+            sql = grp['normalized']
+            if len(sql) > width:
+                sql = sql[:width-3] + '...'
+            lines.append(f'{grp["calls"]:6d} {grp["total"]*1e3:10.2f}'
+                         + f' {grp["mean"]*1e3:9.3f} {grp["max"]*1e3:9.3f}'
+                         + f' {grp["rows"]:9d} {grp["bytes"]/2**20:8.2f}'
+                         + f'  {sql}')
+        return '\n'.join(lines)
+
+    def report(self, db=None, top=20, explain=3):
+        '''REPORT - Print a ranked summary
+        REPORT() prints the output of TABLE. REPORT(db) also prints the
+        query plans of the EXPLAIN most expensive statements.'''
+        print(self.table(top))
+        if db is not None and explain:
+            for sql, plan in self.explain(db, explain):
+                print()
+                print(sql)
+                for step in plan:
+                    print('    ' + step)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import numpy as np
+import json
+import re
+
+_COLUMN = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)?$')
+
+class Filter:
+    '''FILTER - Structured selection criteria for SBEMDB queries
+
+    f = FILTER(tid=444, typ=[5, 6]) represents the selection of rows
+    whose TID equals 444 and whose TYP is 5 or 6. Each value may be a
+    single value, a list, tuple, set, or numpy array of values (meaning
+    "any of these"), or None (meaning "is null"). All criteria must be
+    satisfied.
+    Column names that are not valid Python identifiers may be passed in
+    a dict, as in FILTER({'post.tid': 444}).
+
+    A FILTER may be passed to SBEMDB methods wherever they accept a
+    WHERE clause. Unlike a string clause, a FILTER is compiled to SQL
+    with "?" placeholders and separately bound values, so that the text
+    of the query depends only on which columns are used, not on their
+    values. SQLite can then reuse the prepared statement from its
+    statement cache rather than parsing the query again. Lists of any
+    length are bound as a single JSON array, so they do not change the
+    text of the query either.
+
+    Filters may be combined with "&".'''
+    def __init__(self, cols=None, **kwargs):
+        self.cols = {}
+        if cols is not None:
+            self.cols.update(cols)
+        self.cols.update(kwargs)
+        for name in self.cols:
+            if not _COLUMN.match(name):
+                raise ValueError(f'Bad column name: {name}')
+
+    def __repr__(self):
+        args = ', '.join(f'{k}={v!r}' for k, v in self.cols.items())
+        return f'Filter({args})'
+
+    def __bool__(self):
+        return len(self.cols) > 0
+
+    def __and__(self, other):
+        res = Filter(self.cols)
+        for name, val in other.cols.items():
+            if name in res.cols:
+                raise ValueError(f'Column {name} used in both filters')
+            res.cols[name] = val
+        return res
+
+    def _ismany(val):
+        return isinstance(val, (list, tuple, set, frozenset, range,
+                                np.ndarray))
+
+    def _plain(val):
+        # Convert numpy scalars to python scalars that sqlite3 can bind
+        if isinstance(val, np.generic):
+            return val.item()
+        return val
+
+    def sql(self, aliases=None):
+        '''SQL - Compile to SQL
+        (clause, params) = SQL() returns an SQL expression with "?"
+        placeholders, and a list of values to bind to those placeholders.
+        If the filter is empty, CLAUSE is the empty string.
+        Optional argument ALIASES maps column names used in the filter to
+        the SQL expressions that should be used in their place (e.g.,
+        "pretid" to "pre.tid"). Names not in ALIASES are used as is.'''
+        if aliases is None:
+            aliases = {}
+        terms = []
+        params = []
+        for name, val in self.cols.items():
+            col = aliases.get(name, name)
+            if val is None:
+                terms.append(f'{col} is null')
+            elif Filter._ismany(val):
+                vals = [ Filter._plain(v) for v in np.asarray(list(val)).ravel() ]
+                terms.append(f'{col} in (select value from json_each(?))')
+                params.append(json.dumps(vals))
+            else:
+                terms.append(f'{col}=?')
+                params.append(Filter._plain(val))
+        return ' and '.join(terms), params
+
+    def mask(self, columns):
+        '''MASK - Apply the filter to in-memory columns
+        keep = MASK(columns), where COLUMNS is a dict mapping column names
+        to equal-length arrays, returns a boolean array that is True for
+        rows that satisfy the filter. Raises KeyError if the filter uses a
+        column that is not in COLUMNS.'''
+        keep = None
+        for name, val in self.cols.items():
+            col = columns[name]
+            if keep is None:
+                keep = np.ones(len(col), dtype=bool)
+            if val is None:
+                keep[:] = False
+            elif Filter._ismany(val):
+                keep &= np.isin(col, np.asarray(list(val)))
+            else:
+                keep &= col == val
+        if keep is None:
+            n = len(next(iter(columns.values()))) if columns else 0
+            keep = np.ones(n, dtype=bool)
+        return keep
+
+    def columns(self):
+        '''COLUMNS - Names of the columns used by the filter'''
+        return list(self.cols.keys())
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import collections
+import sys
+import threading
+import numpy as np
+
+def sizeof(value):
+    '''SIZEOF - Approximate memory footprint of a query result
+    n = SIZEOF(value) returns the approximate number of bytes used by
+    VALUE, which must be a numpy array or a list of tuples as returned
+    by sqlite3's FETCHALL.'''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    n = sys.getsizeof(value)
+    for row in value:
+        n += sys.getsizeof(row)
+        for v in row:
+            n += sys.getsizeof(v)
+    return n
+
+class QueryCache:
+    '''QUERYCACHE - Least-recently-used cache of query results
+
+    qc = QUERYCACHE(maxbytes) creates an empty cache that holds at most
+    MAXBYTES bytes of results (as estimated by SIZEOF). When a new result
+    would exceed that, the least recently used results are evicted.
+    Results larger than MAXBYTES are not cached at all.
+
+    The cache is tied to a "state" of the database (any comparable
+    value, e.g., a file's size and modification time). VALIDATE clears
+    the cache whenever the state changes.
+
+    Counters HITS, MISSES, EVICTIONS, and INVALIDATIONS record the use of
+    the cache; STATS returns them as a dict.'''
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict() # key -> (value, nbytes)
+        self.nbytes = 0
+        self.state = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def validate(self, state):
+        '''VALIDATE - Clear the cache if the database has changed
+        VALIDATE(state) clears the cache unless STATE equals the state
+        passed to the previous call.'''
+        with self.lock:
+            if state != self.state:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.nbytes = 0
+                self.state = state
+
+    def get(self, key):
+        '''GET - Look up a result
+        (found, value) = GET(key) returns (True, value) if the cache
+        contains a result for KEY, or (False, None) if not.'''
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, ent[0]
+
+    def put(self, key, value):
+        '''PUT - Store a result
+        PUT(key, value) stores VALUE under KEY, evicting older results as
+        needed to stay within MAXBYTES.'''
+        n = sizeof(value)
+        if n > self.maxbytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            while self.entries and self.nbytes + n > self.maxbytes:
+                _, (_, m) = self.entries.popitem(last=False)
+                self.nbytes -= m
+                self.evictions += 1
+            self.entries[key] = (value, n)
+            self.nbytes += n
+
+    def clear(self):
+        '''CLEAR - Forget all results'''
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.state = None
+
+    def stats(self):
+        '''STATS - Usage statistics
+        STATS() returns a dict with the number of HITS, MISSES, EVICTIONS,
+        and INVALIDATIONS so far, as well as the current number of ENTRIES
+        and their total size in BYTES.'''
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses,
+                     'evictions': self.evictions,
+                     'invalidations': self.invalidations,
+                     'entries': len(self.entries), 'bytes': self.nbytes,
+                     'maxbytes': self.maxbytes }
@@ -4,7 +4,21 @@ import numpy as np
 import sqlite3
 import errno
 import os
+import hashlib
+import contextlib
+import time
+import itertools
+import warnings
+import urllib.parse
+import threading
 from . import webaccess
+from . import snapshot
+from . import treeindex
+from . import spatial
+from . import pool
+from . import querycache
+from . import profiler
+from .query import Filter
 
 class LineSegmentGeom:
     def _dif(pa, pb):
@@ -44,6 +58,198 @@ class LineSegmentGeom:
         pp = LineSegmentGeom._addmul(p1, dif2, t)
         return LineSegmentGeom._length(LineSegmentGeom._dif(p, pp))
 
+    def _segments(p1, p2):
+        p1 = np.asarray(p1, dtype=float)
+        p2 = np.asarray(p2, dtype=float)
+        p1, p2 = np.broadcast_arrays(np.atleast_2d(p1), np.atleast_2d(p2))
+        return p1, p2 - p1
+
+    def closestParameters(pp, p1, p2):
+        '''CLOSESTPARAMETERS - Position of closest points on line segments
+        t = CLOSESTPARAMETERS(pp, p1, p2), where PP is an Mx3 array of
+        points and P1 and P2 are Kx3 arrays of segment end points, returns
+        an MxK array of parameters T such that P1 + T (P2-P1) is the point
+        on each segment closest to each point. T is clipped to [0, 1].
+        (Any of PP, P1, P2 may also be a single (x,y,z)-triplet.)
+        For degenerate segments (P1 = P2), T is zero.'''
+        pp = np.atleast_2d(np.asarray(pp, dtype=float))
+        p1, dp = LineSegmentGeom._segments(p1, p2)
+        # As in POINTDISTANCE, T = sum_i [P_i - P1_i][P2_i - P1_i] / |P2-P1|²
+        num = pp @ dp.T - np.sum(p1 * dp, 1)
+        denom = np.sum(dp * dp, 1)
+        t = np.divide(num, denom, out=np.zeros(num.shape), where=denom>0)
+        return np.clip(t, 0, 1)
+
+    def pointDistances(pp, p1, p2):
+        '''POINTDISTANCES - Distances between many points and segments
+        dd = POINTDISTANCES(pp, p1, p2), where PP is an Mx3 array of points
+        and P1 and P2 are Kx3 arrays of segment end points, returns an MxK
+        array of Euclidean distances between each point and each segment.
+        This is the vectorized equivalent of POINTDISTANCE. Memory use is
+        proportional to M times K; see NEARESTSEGMENT for a bounded
+        alternative when only the nearest segment is needed.'''
+        pp = np.atleast_2d(np.asarray(pp, dtype=float))
+        p1, dp = LineSegmentGeom._segments(p1, p2)
+        t = LineSegmentGeom.closestParameters(pp, p1, p1 + dp)
+        dd = np.zeros(t.shape)
+        for k in range(3):
+            dd += (p1[None,:,k] + t*dp[None,:,k] - pp[:,None,k])**2
+        return np.sqrt(dd)
+
+    def segmentDistances(a1, a2, b1, b2):
+        '''SEGMENTDISTANCES - Distances between pairs of line segments
+        dd = SEGMENTDISTANCES(a1, a2, b1, b2) returns the Euclidean
+        distances between the segments from A1 to A2 and the segments
+        from B1 to B2. All arguments are Nx3 arrays (or broadcastable to
+        such); the result has length N.'''
+        a1, a2, b1, b2 = np.broadcast_arrays(*[ np.atleast_2d(np.asarray(
+            q, dtype=float)) for q in (a1, a2, b1, b2) ])
+        # Minimize |A1 + S (A2-A1) - B1 - T (B2-B1)|² over 0 <= S, T <= 1,
+        # by first solving for S with T unconstrained, clipping S, then
+        # solving for T given S, clipping T, and finally re-solving for S.
+        da = a2 - a1
+        db = b2 - b1
+        r = a1 - b1
+        aa = np.sum(da*da, 1)
+        bb = np.sum(db*db, 1)
+        ab = np.sum(da*db, 1)
+        ar = np.sum(da*r, 1)
+        br = np.sum(db*r, 1)
+        den = aa*bb - ab*ab
+        s = np.divide(ab*br - ar*bb, den, out=np.zeros(len(aa)),
+                      where=den>1e-12*aa*bb)
+        s = np.clip(s, 0, 1)
+        t = np.divide(ab*s + br, bb, out=np.zeros(len(aa)), where=bb>0)
+        t = np.clip(t, 0, 1)
+        s = np.divide(ab*t - ar, aa, out=np.zeros(len(aa)), where=aa>0)
+        s = np.clip(s, 0, 1)
+        dif = r + s[:,None]*da - t[:,None]*db
+        return np.sqrt(np.sum(dif*dif, 1))
+
+    def nearestSegment(pp, p1, p2, exclude=None, block=1<<20):
+        '''NEARESTSEGMENT - Nearest segment to each of many points
+        (dd, kk) = NEARESTSEGMENT(pp, p1, p2), where PP is an Mx3 array of
+        points and P1 and P2 are Kx3 arrays of segment end points, returns
+        for each point the distance to the nearest segment and the index
+        of that segment. Ties are broken in favor of the lowest index.
+        Optional argument EXCLUDE is an MxK boolean array (or a function
+        that takes arrays of point indices and segment indices and returns
+        such an array for that block) that marks pairs to ignore. If all
+        segments are excluded for a point, its distance is infinite and
+        its index is -1.
+        Points and segments are processed in blocks of at most BLOCK pairs,
+        so memory use stays bounded even for millions of each.'''
+        pp = np.atleast_2d(np.asarray(pp, dtype=float))
+        p1, dp = LineSegmentGeom._segments(p1, p2)
+        p2 = p1 + dp
+        M = len(pp)
+        K = len(p1)
+        dd = np.full(M, np.inf)
+        kk = np.full(M, -1)
+        bk = max(1, min(K, block))
+        bm = max(1, block // bk)
+        for m0 in range(0, M, bm):
+            m1 = min(m0 + bm, M)
+            mm = np.arange(m0, m1)
+            for k0 in range(0, K, bk):
+                k1 = min(k0 + bk, K)
+                d = LineSegmentGeom.pointDistances(pp[m0:m1],
+                                                   p1[k0:k1], p2[k0:k1])
+                if exclude is not None:
+                    if callable(exclude):
+                        ex = exclude(mm, np.arange(k0, k1))
+                    else:
+                        ex = exclude[m0:m1, k0:k1]
+                    d[ex] = np.inf
+                k = np.argmin(d, 1)
+                d = d[np.arange(m1 - m0), k]
+                better = d < dd[m0:m1]
+                dd[m0:m1][better] = d[better]
+                kk[m0:m1][better] = k[better] + k0
+        return dd, kk
+
+
+# SQLite limits the number of bound parameters per statement. Lists of
+# IDs are split into chunks of this size.
+MAXPARAMS = 900
+
+# Number of prepared statements that each connection keeps for reuse
+STATEMENTCACHE = 256
+
+# Memory map size (bytes) and page cache size (KiB) for read-only
+# connections
+MMAPSIZE = 1 << 30
+CACHESIZE = 1 << 16
+
+# Default size (bytes) of the query result cache (see USEQUERYCACHE)
+QUERYCACHESIZE = 1 << 28
+
+# Tables that SUBSET filters by tree. Any other tables are copied whole.
+# Each is given as the condition that selects rows of the source table
+# (alias "x") given the tables already copied into "main".
+SUBSETTABLES = [
+    ('trees', 'x.tid in (select tid from temp.keeptids)'),
+    ('nodes', 'x.tid in (select tid from temp.keeptids)'),
+    ('nodecons', '''x.nid1 in (select nid from main.nodes)
+                    and x.nid2 in (select nid from main.nodes)'''),
+    ('syncons', 'x.nid in (select nid from main.nodes)'),
+    ('synapses', '''x.sid in (select sid from main.syncons)
+                    and x.sid not in (select sid from temp.dropsids)'''),
+    ('tags', 'x.nid in (select nid from main.nodes)'),
+]
+
+_subsetids = itertools.count(1)
+
+def _filepath(dbfn):
+    # The file named by a database name that may be a "file:" URI, or
+    # None for an in-memory database
+    if not dbfn.startswith('file:'):
+        return dbfn
+    parts = urllib.parse.urlsplit(dbfn)
+    if 'mode=memory' in parts.query:
+        return None
+    return urllib.parse.unquote(parts.path)
+
+# Indexes that the joins in PRESYNTREES, SYNAPSES, SEGMENTS, and
+# friends need, as (name, table, columns). Each index also contains
+# the columns that those queries read, so that they can be answered
+# from the index alone.
+INDEXES = [
+    ('nodes_tid_typ', 'nodes', 'tid, typ, nid'),
+    ('nodecons_nid1', 'nodecons', 'nid1, nid2'),
+    ('nodecons_nid2', 'nodecons', 'nid2, nid1'),
+    ('syncons_sid', 'syncons', 'sid, nid'),
+    ('syncons_nid', 'syncons', 'nid, sid'),
+]
+
+# Representative queries for which OPTIMIZE reports query plans. Each
+# takes one parameter, a tree ID.
+PLANQUERIES = {
+    'presyntrees': '''select a.tid, count(1) from nodes as a
+        inner join syncons as sca on a.nid==sca.nid
+        inner join synapses as s on sca.sid==s.sid
+        inner join syncons as scb on scb.sid==s.sid
+        inner join nodes as b on scb.nid==b.nid
+        inner join trees on a.tid==trees.tid
+        where b.tid=? and a.typ==5 and b.typ==6 group by a.tid''',
+    'synapses': '''select a.nid, b.nid from trees as pre
+        inner join nodes as a on pre.tid==a.tid
+        inner join syncons as sca on a.nid==sca.nid
+        inner join synapses as s on sca.sid==s.sid
+        inner join syncons as scb on scb.sid==s.sid
+        inner join nodes as b on scb.nid==b.nid
+        inner join trees as post on b.tid==post.tid
+        where a.typ==5 and b.typ==6 and post.tid=?''',
+    'segments': '''select nodes.nid, b.nid from nodes
+        inner join nodecons as c on nodes.nid==c.nid1
+        inner join nodes as b on c.nid2==b.nid
+        where nodes.nid<b.nid and nodes.tid=? order by nodes.nid''',
+    'treecons': '''select nc.ncid from nodecons as nc
+        inner join nodes as a on nc.nid1==a.nid
+        inner join nodes as b on nc.nid2==b.nid
+        where a.tid=?1 and b.tid=?1 and nc.nid1<nc.nid2''',
+    'nodexyz': '''select nid, x, y, z from nodes where tid=?1 and typ==1''',
+}
 
 class Node:
     def __init__(self, nid, tid, typ, x, y, z, cdate, uid):
@@ -59,19 +265,576 @@ class Node:
         self.uid = uid
 
 class SBEMDB:
-    def __init__(self, dbfn=None):
+    def __init__(self, dbfn=None, cache=False, readonly=False,
+                 max_connections=None, querycache=None):
         '''SBEMDB - Pythonic access to SBEMDB
         db = SBEMDB(dbfn) opens the given database file. db = SBEMDB() opens
-        the database file in the em170428 directory.'''
+        the database file in the em170428 directory.
+        db = SBEMDB(dbfn, cache=True) immediately loads a SNAPSHOT of the
+        database, using a sidecar cache directory next to the database
+        file (see SNAPSHOT). CACHE may also be "hash" to validate the
+        cache against the contents of the database file rather than only
+        its size and modification time.
+        Methods that take a WHERE clause accept either an SQL string or
+        a FILTER (see the query module). Filters, and the queries that
+        methods build internally, bind their values as parameters, so
+        that SQLite can reuse its prepared statements.
+        db = SBEMDB(dbfn, readonly=True) opens the database read-only,
+        with the profile described under OPTIMIZE.
+        db = SBEMDB(dbfn, max_connections=N) opens the database read-only
+        in pooled mode: each query borrows one of at most N connections
+        from a CONNECTIONPOOL (see the pool module), so that all query
+        methods may be called concurrently from several threads, e.g.,
+        from a ThreadPoolExecutor. Indexes and other lazily built caches
+        are then each built only once, even if requested by several
+        threads at the same time.
+        db = SBEMDB(dbfn, querycache=NBYTES) keeps up to NBYTES of query
+        results in memory (see USEQUERYCACHE).'''
         dbfn = webaccess.ensurefile(dbfn, "170428_pub.sbemdb")
-        self.db = sqlite3.connect(dbfn)
         self.dbfn = dbfn
+        self.uri = dbfn.startswith('file:')
+        self.memory = self.uri and 'mode=memory' in dbfn
+        self.path = _filepath(dbfn)
+        self.readonly = readonly or max_connections is not None
+        self.max_connections = max_connections
+        if self.memory:
+            # An in-memory database lives as long as a connection to it
+            self.keeper = self._rawconnect()
+        self.lock = threading.RLock()
+        self.buildlocks = {}
+        self.hooks = []
+        self.qcache = None
+        if querycache:
+            self.usequerycache(querycache)
+        self._open()
+        self.snap = None
+        self.snapcache = False
+        self.indices = {}
+        self.grids = {}
+        self.indexstate = None
+        if cache:
+            self.snapshot(cache=True, hashcontent=(cache=='hash'))
+
+    def _rawconnect(self):
+        # Open a plain read-write connection to the database
+        return sqlite3.connect(self.dbfn, uri=self.uri,
+                               cached_statements=STATEMENTCACHE,
+                               check_same_thread=(self.max_connections
+                                                  is None))
+
+    def _connect(self):
+        # Open a new connection to the database file, read-only and with
+        # tuned caches if SELF.READONLY is set
+        shared = self.max_connections is None
+        if not self.readonly:
+            return self._rawconnect()
+        if self.uri:
+            # Cannot reopen a URI read-only, but can refuse to write
+            con = self._rawconnect()
+            con.execute('pragma query_only=1')
+            return con
+        path = urllib.parse.quote(os.path.abspath(self.dbfn))
+        con = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True,
+                              cached_statements=STATEMENTCACHE,
+                              check_same_thread=shared)
+        con.execute(f'pragma mmap_size={int(MMAPSIZE)}')
+        con.execute(f'pragma cache_size={-int(CACHESIZE)}')
+        return con
+
+    def _open(self):
+        # (Re)open the connection or connection pool
+        self.local = threading.local()
+        if self.qcache is not None:
+            self.qcache.clear()
+        if self.max_connections is None:
+            self.pool = None
+            self.con = self._connect()
+        else:
+            self.pool = pool.ConnectionPool(self._connect, self.max_connections)
+            self.con = None
+
+    def _close(self):
+        if self.pool is None:
+            self.con.close()
+        else:
+            self.pool.close()
+
+    @property
+    def db(self):
+        '''DB - The underlying sqlite3 connection
+        In pooled mode, this is a connection private to the calling thread,
+        which does not count against MAX_CONNECTIONS. Query methods do not
+        use it; it exists for code that needs a connection of its own.'''
+        if self.pool is None:
+            return self.con
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = self.local.con = self._connect()
+        return con
+
+    def connection(self):
+        '''CONNECTION - Borrow a connection for running queries
+        with db.CONNECTION() as con: ... runs the block with a connection
+        to the database. In pooled mode, the connection is taken from the
+        pool and returned afterwards, so it must not be used outside the
+        block.'''
+        if self.pool is None:
+            return contextlib.nullcontext(self.con)
+        return self.pool.connection()
+
+    def _cached(self, store, key, build):
+        # Return STORE[KEY], calling BUILD() to create it if it does not
+        # yet exist. If several threads ask for the same KEY at once, only
+        # one of them builds it.
+        try:
+            return store[key]
+        except KeyError:
+            pass
+        with self.lock:
+            lock = self.buildlocks.setdefault((id(store), key),
+                                              threading.Lock())
+        with lock:
+            if key not in store:
+                store[key] = build()
+        return store[key]
+
+    def ensure_indexes(self):
+        '''ENSURE_INDEXES - Create indexes needed for fast queries
+        names = ENSURE_INDEXES() creates any of the indexes listed in
+        INDEXES that do not yet exist in the database file, and runs
+        ANALYZE so that the query planner knows about them. Returns the
+        names of the indexes that were created.
+        This requires write access to the database file, even if the
+        database was opened read-only.'''
+        con = self._rawconnect()
+        try:
+            have = { row[0] for row in con.execute('''select name
+                     from sqlite_master where type=="index"''') }
+            created = []
+            for name, table, cols in INDEXES:
+                if name not in have:
+                    con.execute(f'create index {name} on {table} ({cols})')
+                    created.append(name)
+            con.execute('analyze')
+            con.commit()
+        finally:
+            con.close()
+        # Reconnect so that the schema change is seen even by an
+        # "immutable" connection
+        self._close()
+        self._open()
+        return created
+
+    def queryplan(self, query, params=()):
+        '''QUERYPLAN - How SQLite will execute a query
+        plan = QUERYPLAN(query, params) returns the output of EXPLAIN
+        QUERY PLAN for the given query as a list of strings, one per
+        step, indented to show nesting.'''
+        depth = { 0: 0 }
+        res = []
+        for row in self.fetch(f'explain query plan {query}', params):
+            nid, parent, detail = row[0], row[1], row[-1]
+            depth[nid] = depth.get(parent, 0) + 1
+            res.append('  ' * (depth[nid] - 1) + detail)
+        return res
+
+    def queryplans(self):
+        '''QUERYPLANS - Query plans for representative queries
+        plans = QUERYPLANS() returns a dict mapping the names of the
+        queries in PLANQUERIES to their QUERYPLAN.'''
+        return { name: self.queryplan(query, (0,))
+                 for name, query in PLANQUERIES.items() }
+
+    def optimize(self, indexes=True):
+        '''OPTIMIZE - Prepare the database for fast read-only access
+        report = OPTIMIZE() runs ENSURE_INDEXES and then reopens the
+        database read-only, through an "immutable" URI, with a memory map
+        of MMAPSIZE bytes and a page cache of CACHESIZE KiB. SQLite then
+        does no locking and reads pages straight from the memory map.
+        Because the database is opened as immutable, changes made to the
+        file by others are not seen until it is reopened.
+        OPTIMIZE(indexes=False) skips ENSURE_INDEXES, e.g., if the file
+        is not writable.
+        The result is a dict mapping the names of the queries in
+        PLANQUERIES to pairs (before, after) of their QUERYPLAN before and
+        after optimization.'''
+        before = self.queryplans()
+        if indexes:
+            self.ensure_indexes()
+        self.readonly = True
+        self._close()
+        self._open()
+        after = self.queryplans()
+        return { name: (before[name], after[name]) for name in before }
+
+    def rowcounts(self, tables=None):
+        '''ROWCOUNTS - Number of rows in tables
+        cnt = ROWCOUNTS() returns a dict mapping the names of all tables
+        in the database to the number of rows they contain. Optional
+        argument TABLES restricts the result to the given tables.'''
+        if tables is None:
+            tables = [ row[0] for row in self.fetch('''select name
+                       from sqlite_master where type=="table"
+                       and name not like "sqlite_%"''') ]
+        return { table: self.fetch(f'select count(*) from "{table}"')[0][0]
+                 for table in tables }
+
+    def subset(self, tids, dbfn=None, dropsids=(), verbose=False):
+        '''SUBSET - Database restricted to a set of trees
+        sub = SUBSET(tids) returns a new SBEMDB that contains only the
+        given trees, their nodes, the node connections between those
+        nodes, the synapse connections and tags of those nodes, and the
+        synapses that retain at least one synapse connection. Other
+        tables (e.g., nodetypes) are copied whole, as are the indexes
+        of the original database.
+        By default, the new database lives in memory only; it is discarded
+        when SUB is. Optional argument DBFN names a file to write it to
+        instead; an existing file of that name is overwritten.
+        Optional argument DROPSIDS lists synapses to leave out regardless.
+        The rows are copied directly from this database into the new one
+        by the database engine (using ATTACH and INSERT ... SELECT against
+        a temporary table of tree IDs), so that nothing needs to pass
+        through Python.
+        If VERBOSE is True, the number of rows in each table before and
+        after is printed.'''
+        if dbfn is None:
+            dbfn = (f'file:sbemdb_subset_{os.getpid()}_{next(_subsetids)}'
+                    + '?mode=memory&cache=shared')
+        elif _filepath(dbfn) is not None:
+            if os.path.exists(_filepath(dbfn)):
+                os.remove(_filepath(dbfn))
+        if self.uri:
+            srcuri = self.dbfn
+        else:
+            path = urllib.parse.quote(os.path.abspath(self.dbfn))
+            srcuri = f'file:{path}?mode=ro'
+        sub = SBEMDB(dbfn)
+        con = sub._rawconnect()
+        try:
+            # Attaching by URI requires a connection opened with uri=True
+            if not sub.uri:
+                con.close()
+                path = urllib.parse.quote(os.path.abspath(dbfn))
+                con = sqlite3.connect(f'file:{path}', uri=True)
+            con.execute('attach database ? as src', (srcuri,))
+            tables = con.execute('''select name, sql from src.sqlite_master
+                     where type=="table" and name not like "sqlite_%"
+                     and sql is not null''').fetchall()
+            for name, sql in tables:
+                con.execute(sql)
+            con.execute('create temp table keeptids (tid integer primary key)')
+            con.executemany('insert or ignore into temp.keeptids values (?)',
+                            [ (int(t),) for t in np.atleast_1d(tids) ])
+            con.execute('create temp table dropsids (sid integer primary key)')
+            con.executemany('insert or ignore into temp.dropsids values (?)',
+                            [ (int(s),) for s in np.atleast_1d(dropsids) ])
+            names = [ name for name, sql in tables ]
+            conds = dict(SUBSETTABLES)
+            # Filtered tables in order of dependence, then the others
+            order = ([ name for name, cond in SUBSETTABLES if name in names ]
+                     + [ name for name in names if name not in conds ])
+            for name in order:
+                cond = conds.get(name, '1')
+                con.execute(f'''insert into main."{name}"
+                            select x.* from src."{name}" as x where {cond}''')
+            for (sql,) in con.execute('''select sql from src.sqlite_master
+                     where type=="index" and sql is not null''').fetchall():
+                con.execute(sql)
+            con.commit()
+            con.execute('detach database src')
+        finally:
+            con.close()
+        if verbose:
+            before = self.rowcounts(names)
+            after = sub.rowcounts(names)
+            for name in names:
+                print(f'{name}: {before[name]} -> {after[name]}')
+        return sub
+
+    def _clause(self, where, aliases=None):
+        # Convert WHERE, which may be an SQL string or a FILTER, into an
+        # SQL expression and a list of parameters
+        if isinstance(where, Filter):
+            return where.sql(aliases)
+        return where, []
+
+    def usequerycache(self, maxbytes=QUERYCACHESIZE):
+        '''USEQUERYCACHE - Remember the results of queries
+        USEQUERYCACHE(maxbytes) makes FETCH and FETCHARRAY (and hence all
+        the query methods) keep the results of SELECT queries in a
+        least-recently-used QUERYCACHE (see the querycache module) of at
+        most MAXBYTES bytes. Repeating a query with the same parameters
+        then returns a copy of the remembered result without consulting
+        the database. Queries are matched by their exact text.
+        The cache is cleared whenever the database file changes on disk
+        (size or modification time), when another connection commits a
+        change (PRAGMA data_version), and when anything is written through
+        this object's own connection, e.g., through db.db.cursor().
+        Results are not cached while such writes are not yet committed.
+        USEQUERYCACHE(None) turns the cache off.'''
+        if maxbytes:
+            self.qcache = querycache.QueryCache(maxbytes)
+        else:
+            self.qcache = None
 
-    def fetch(self, query):
-        c = self.db.cursor()
-        c.execute(query)
-        return c.fetchall()
+    def cachestats(self):
+        '''CACHESTATS - Query cache statistics
+        CACHESTATS() returns a dict with the numbers of hits and misses of
+        the query cache, and more; see QUERYCACHE.STATS. Returns None if
+        the cache is not in use.'''
+        if self.qcache is None:
+            return None
+        return self.qcache.stats()
+
+    def _cachekey(self, con, kind, query, params, dtype=None):
+        # Return the key for looking up a query in the query cache, or
+        # None if the query should not be cached. Clears the cache if the
+        # database has changed.
+        if self.qcache is None:
+            return None
+        if not query.lstrip().lower().startswith(('select', 'with')):
+            return None
+        if con.in_transaction:
+            # Uncommitted changes might yet be rolled back
+            return None
+        self.qcache.validate(self._dbstate(con))
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        else:
+            params = tuple(params)
+        return (kind, query, params, dtype)
+
+    def addhook(self, hook):
+        '''ADDHOOK - Add an instrumentation hook
+        ADDHOOK(hook) arranges for HOOK(query, params, seconds, rows,
+        nbytes) to be called after every statement that FETCH, FETCHARRAY,
+        or ITERFETCH (and hence any query method) executes, with the wall
+        time spent, the number of rows returned, and the approximate size
+        of the result. Results served from the query cache are not
+        reported, since they do not execute any statement.'''
+        self.hooks = self.hooks + [hook]
+
+    def removehook(self, hook):
+        '''REMOVEHOOK - Remove a hook added by ADDHOOK'''
+        self.hooks = [ h for h in self.hooks if h is not hook ]
+
+    @contextlib.contextmanager
+    def profile(self):
+        '''PROFILE - Record the statements executed in a block
+        with db.PROFILE() as prof: ... records every statement executed
+        during the block in a PROFILER (see the profiler module).
+        Afterwards, PROF.REPORT(db) prints a ranked summary with query
+        plans of the slowest statements.'''
+        prof = profiler.Profiler()
+        self.addhook(prof.record)
+        try:
+            yield prof
+        finally:
+            self.removehook(prof.record)
+
+    def _notify(self, query, params, seconds, rows, nbytes):
+        for hook in self.hooks:
+            hook(query, params, seconds, rows, nbytes)
+
+    def _execute(self, con, query, params, materialize):
+        # Execute QUERY on CON and return MATERIALIZE(cursor). All
+        # statements go through here (or ITERFETCH) so that hooks see them.
+        t0 = time.perf_counter()
+        c = con.cursor()
+        c.execute(query, params)
+        res = materialize(c)
+        if self.hooks:
+            self._notify(query, params, time.perf_counter() - t0,
+                         len(res), querycache.sizeof(res))
+        return res
+
+    def fetch(self, query, params=()):
+        with self.connection() as con:
+            key = self._cachekey(con, 'fetch', query, params)
+            if key is not None:
+                found, res = self.qcache.get(key)
+                if found:
+                    return list(res)
+            res = self._execute(con, query, params, lambda c: c.fetchall())
+            if key is not None:
+                self.qcache.put(key, list(res))
+            return res
+
+    def fetcharray(self, query, dtype, params=()):
+        '''FETCHARRAY - Fetch query results as a structured array
+        rec = FETCHARRAY(query, dtype) executes the given query and returns
+        the results as a numpy structured array. DTYPE must be a list of
+        (name, type) pairs, one for each column selected by the query.
+        Rows are decoded straight from the cursor into typed columns,
+        without an intermediate list of tuples.
+        Optional argument PARAMS supplies values for "?" placeholders in
+        the query.'''
+        dtype = np.dtype(dtype)
+        with self.connection() as con:
+            key = self._cachekey(con, 'array', query, params, dtype)
+            if key is not None:
+                found, rec = self.qcache.get(key)
+                if found:
+                    return rec.copy()
+            rec = self._execute(con, query, params,
+                                lambda c: np.fromiter(c, dtype=dtype))
+            if key is not None:
+                self.qcache.put(key, rec.copy())
+            return rec
         
+    def iterfetch(self, query, dtype, params=(), chunk=100000):
+        '''ITERFETCH - Fetch query results in chunks
+        for rec in ITERFETCH(query, dtype, params, chunk): ... executes the
+        given query and yields the results as numpy structured arrays (as
+        from FETCHARRAY) of at most CHUNK rows each, reading them from
+        the database with FETCHMANY as needed. Memory use thus depends on
+        CHUNK, not on the size of the result.
+        The query cache (see USEQUERYCACHE) is not used. In pooled mode,
+        a connection is held until the iteration finishes or the
+        iterator is closed.'''
+        dtype = np.dtype(dtype)
+        with self.connection() as con:
+            t0 = time.perf_counter()
+            c = con.cursor()
+            c.arraysize = chunk
+            c.execute(query, params)
+            dt = 0
+            nrows = 0
+            nbytes = 0
+            try:
+                while True:
+                    rows = c.fetchmany(chunk)
+                    if not rows:
+                        break
+                    rec = np.array(rows, dtype=dtype)
+                    dt += time.perf_counter() - t0
+                    nrows += len(rec)
+                    nbytes += rec.nbytes
+                    yield rec
+                    t0 = time.perf_counter()
+                    if len(rows) < chunk:
+                        break
+            finally:
+                # Time spent by the consumer between chunks is not counted
+                self._notify(query, params, dt, nrows, nbytes)
+
+    def _filestate(self):
+        # Something that changes when the database is modified
+        if self.memory:
+            dv = self.keeper.execute('pragma data_version').fetchone()[0]
+            return (self.dbfn, dv)
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime_ns)
+
+    def _dbstate(self, con):
+        # Something that changes when the database is modified, either
+        # through CON or by anybody else
+        state = self._filestate()
+        if self.pool is None:
+            # Pooled connections are immutable, so only the file matters
+            dv = con.execute('pragma data_version').fetchone()[0]
+            state += (id(con), dv, con.total_changes)
+        return state
+
+    def _validateindices(self):
+        # Forget the indices built by TREEINDEX and SPATIALINDEX if the
+        # database has changed since they were built. (With a snapshot
+        # loaded, they are built from the snapshot, which does not change.)
+        if self.snap is not None:
+            return
+        with self.connection() as con:
+            if con.in_transaction:
+                # Uncommitted changes might yet be rolled back
+                state = object()
+            else:
+                state = self._dbstate(con)
+        with self.lock:
+            if state != self.indexstate:
+                self.indices = {}
+                self.grids = {}
+                self.indexstate = state
+
+    def fingerprint(self, hashcontent=False):
+        '''FINGERPRINT - Identify the current state of the database file
+        fp = FINGERPRINT() returns a dict with the size and modification
+        time of the database file. FINGERPRINT(True) also includes a SHA-1
+        hash of the contents of the file, which is slower but also detects
+        changes that leave size and modification time intact.
+        For an in-memory database (see SUBSET), the result instead
+        contains its name and a version number that changes whenever
+        anything is committed to it.'''
+        if self.memory:
+            name, version = self._filestate()
+            return { 'memory': name, 'version': version }
+        st = os.stat(self.path)
+        fp = { 'size': st.st_size, 'mtime': st.st_mtime_ns }
+        if hashcontent:
+            h = hashlib.sha1()
+            with open(self.path, 'rb') as fd:
+                for blk in iter(lambda: fd.read(1<<20), b''):
+                    h.update(blk)
+            fp['sha1'] = h.hexdigest()
+        return fp
+
+    def cachedir(self):
+        '''CACHEDIR - Name of the sidecar cache directory
+        CACHEDIR() returns the name of the directory in which SNAPSHOT
+        caches its arrays: the database file name with ".cache" appended,
+        or None for an in-memory database.'''
+        if self.memory:
+            return None
+        return self.path + '.cache'
+
+    def snapshot(self, cache=False, hashcontent=False):
+        '''SNAPSHOT - Load the entire database into memory
+        snap = SNAPSHOT() loads all nodes, node connections, and synapses
+        into numpy arrays (see the SNAPSHOT class in the snapshot module)
+        and returns the result. From then on, ONENODEXYZ, NODEXYZMANY,
+        SOMAXYZ, TREEOF, TREENODES, TREECONS, DISTANCEALONGTREE,
+        PATHBETWEENNODES, and the methods that depend on them run against
+        those arrays rather than against the SQL database. So do NODEXYZ,
+        SYNAPSES, PRESYNTREES, CONNECTIVITY, SIMPLESEGMENTS, SEGMENTS, and
+        the like when their WHERE arguments are FILTERs (or empty); raw SQL
+        clauses still go to the database, as do NODEDETAILS and
+        NODEDETAILSMANY, which report columns that the snapshot does not
+        hold (raw coordinates, CDATE, and UID). The snapshot is not updated when the
+        database is modified; call SNAPSHOT again to reload it, or
+        DROPSNAPSHOT to go back to SQL queries.
+        SNAPSHOT(cache=True) first looks for a previously saved copy of the
+        arrays in the sidecar directory named by CACHEDIR, and memory maps
+        those if the database file has not changed since they were saved
+        (according to FINGERPRINT). Otherwise, the arrays are loaded from
+        the database and saved there for next time. HASHCONTENT is passed
+        to FINGERPRINT. In-memory databases are never cached.
+        SNAPCACHE records how the snapshot was obtained, as for the CACHE
+        argument of the constructor: False, True, or "hash".'''
+        self.indices = {}
+        self.grids = {}
+        self.indexstate = None
+        if not cache or self.memory:
+            self.snap = snapshot.Snapshot(self)
+            self.snapcache = False
+            return self.snap
+        fp = self.fingerprint(hashcontent)
+        snap = snapshot.Snapshot.load(self.cachedir(), fp)
+        if snap is None:
+            snap = snapshot.Snapshot(self)
+            try:
+                snap.save(self.cachedir(), fp)
+            except OSError as e:
+                warnings.warn(f'Could not write cache {self.cachedir()}: {e}')
+        self.snap = snap
+        self.snapcache = 'hash' if hashcontent else True
+        return self.snap
+
+    def dropsnapshot(self):
+        '''DROPSNAPSHOT - Forget the snapshot created by SNAPSHOT'''
+        self.snap = None
+        self.snapcache = False
+        self.indices = {}
+        self.grids = {}
+        self.indexstate = None
+
     def nodetypes(self):
         '''NODETYPES - Get nodetype enum
         NODETYPES() returns a mapping of node type numbers to descriptions.'''
@@ -80,7 +843,7 @@ class SBEMDB:
             res[row[0]] = row[1]
         return res
     
-    def nodexyz(self, where=''):
+    def nodexyz(self, where='', asrecord=False):
         '''NODEXYZ - Get a map of node location
         (x, y, z, nid) = NODEXYZ(whereclause) performs a SELECT on the NODES 
         with the given where clause. For instance,
@@ -96,40 +859,166 @@ class SBEMDB:
         Positive X is to anatomical left.
         Positive Y is to posterior.
         Positive Z is to ventral side.
-        ID is node ID'''
-        if where != '':
-            where = f'where {where}'
-        rows = self.fetch(f'select nid, x, y, z from nodes {where}')
-        N = len(rows)
-        x = np.zeros(N)
-        y = np.zeros(N)
-        z = np.zeros(N)
-        nid = np.zeros(N, dtype=int)
-        for n in range(N):
-            x[n] = rows[n][1]
-            y[n] = rows[n][2]
-            z[n] = rows[n][3]
-            nid[n] = rows[n][0]
-        x = self.pixtoum(x)
-        y = self.pixtoum(y)
-        z = self.slicetoum(z)
+        ID is node ID
+        WHERE may also be a FILTER, e.g., Filter(tid=444, typ=6). If a
+        snapshot is loaded and WHERE is empty or a filter that only uses
+        the columns nid, tid, and typ, the snapshot is used rather than
+        the database.
+        Optional argument ASRECORD makes the result a numpy record array
+        with fields x, y, z, and nid instead of a tuple.'''
+        keep = self._snapmask(where)
+        if keep is not None:
+            x = self.snap.x[keep]
+            y = self.snap.y[keep]
+            z = self.snap.z[keep]
+            nid = self.snap.nid[keep]
+        else:
+            return self._nodexyzresult(self.fetcharray(*self._nodexyzquery(where)),
+                                       asrecord)
+        if asrecord:
+            return np.rec.fromarrays((x, y, z, nid), names='x,y,z,nid')
+        return (x, y, z, nid)
+
+    def _nodexyzquery(self, where):
+        # Query, dtype, and parameters for NODEXYZ
+        clause, params = self._clause(where)
+        if clause != '':
+            clause = f'where {clause}'
+        return (f'select nid, x, y, z from nodes {clause}',
+                [('nid', int), ('x', float), ('y', float), ('z', float)],
+                params)
+
+    def _nodexyzresult(self, rec, asrecord):
+        x = self.pixtoum(rec['x'])
+        y = self.pixtoum(rec['y'])
+        z = self.slicetoum(rec['z'])
+        nid = rec['nid']
+        if asrecord:
+            return np.rec.fromarrays((x, y, z, nid), names='x,y,z,nid')
         return (x, y, z, nid)
 
+    def iternodexyz(self, where='', chunk=100000, asrecord=False):
+        '''ITERNODEXYZ - Get node locations in chunks
+        for (x, y, z, nid) in ITERNODEXYZ(where, chunk): ... iterates over
+        the results of NODEXYZ(where) in chunks of at most CHUNK nodes, so
+        that even a query over all nodes runs in constant memory.
+        ASRECORD is as for NODEXYZ.'''
+        for rec in self.iterfetch(*self._nodexyzquery(where), chunk=chunk):
+            yield self._nodexyzresult(rec, asrecord)
+
+    def _snapmask(self, where, columns=None):
+        # If WHERE is empty or a FILTER that can be evaluated against the
+        # snapshot, return a mask of matching snapshot rows, else None.
+        # COLUMNS, a function of the snapshot, returns the columns to
+        # match; by default, those of the node table.
+        if self.snap is None:
+            return None
+        if isinstance(where, str) and where.strip()=='':
+            where = Filter()
+        if not isinstance(where, Filter):
+            return None
+        if columns is None:
+            cols = { 'nid': self.snap.nid, 'tid': self.snap.tid,
+                     'typ': self.snap.typ }
+        else:
+            cols = columns(self.snap)
+        try:
+            return where.mask(cols)
+        except KeyError:
+            return None
+
+    def _snapedgemask(self, where):
+        # As _SNAPMASK, for the edge table, in terms of the lower-numbered
+        # node of each edge
+        return self._snapmask(where, lambda snap: { 'nid': snap.nid[snap.edge1],
+                                                    'tid': snap.tid[snap.edge1],
+                                                    'typ': snap.typ[snap.edge1] })
+
     def onenodexyz(self, nid):
         '''ONENODEXYZ - Get location of a single node
         (x, y, z) = ONENODEXYZ(nid) returns the location of the given node.
         The result is in microns'''
-        x,y,z,nid = self.nodexyz(f'nid={nid}')
+        if self.snap is not None:
+            ok, row = self.snap._lookup(nid)
+            if not ok:
+                raise ValueError(f'No such node: {nid}')
+            return self.snap.x[row], self.snap.y[row], self.snap.z[row]
+        x,y,z,nid = self.nodexyz(Filter(nid=nid))
         if len(x):
             return x[0], y[0], z[0]
         else:
             raise ValueError(f'No such node: {nid}')
 
+    def _nodesbyid(self, nids, cols, dtype):
+        # Fetch the given columns for a list of nodes using as few
+        # queries as possible, and return them in the order of NIDS.
+        nids = np.asarray(nids, dtype=int).ravel()
+        uniq = np.unique(nids)
+        parts = []
+        for k in range(0, len(uniq), MAXPARAMS):
+            chunk = uniq[k:k+MAXPARAMS].tolist()
+            marks = ','.join('?' * len(chunk))
+            parts.append(self.fetcharray(f'''select nid, {cols} from nodes
+                                         where nid in ({marks})
+                                         order by nid''',
+                                         [('nid', int)] + dtype, chunk))
+        if parts:
+            rec = np.concatenate(parts)
+        else:
+            rec = np.zeros(0, dtype=[('nid', int)] + dtype)
+        if len(rec) < len(uniq):
+            missing = np.setdiff1d(uniq, rec['nid'])
+            raise ValueError(f'No such node: {missing[0]}')
+        return rec[np.searchsorted(rec['nid'], nids)]
+
+    def nodexyzMany(self, nids):
+        '''NODEXYZMANY - Get location of many nodes
+        (x, y, z) = NODEXYZMANY(nids) returns the locations of the given
+        nodes, in the order given, using a single lookup rather than one
+        query per node. NIDS may contain duplicates.
+        The result is in microns. Raises ValueError if any node does not
+        exist.'''
+        if self.snap is not None:
+            ok, rows = self.snap._lookup(np.asarray(nids, dtype=int).ravel())
+            if not np.all(ok):
+                missing = np.asarray(nids).ravel()[~ok]
+                raise ValueError(f'No such node: {missing[0]}')
+            return self.snap.x[rows], self.snap.y[rows], self.snap.z[rows]
+        rec = self._nodesbyid(nids, 'x, y, z',
+                              [('x', float), ('y', float), ('z', float)])
+        return (self.pixtoum(rec['x']), self.pixtoum(rec['y']),
+                self.slicetoum(rec['z']))
+
+    def nodeDetailsMany(self, nids):
+        '''NODEDETAILSMANY - Get details of many nodes
+        nnn = NODEDETAILSMANY(nids) returns a list of Node objects for the
+        given nodes, in the order given, using a single lookup rather than
+        one query per node. Raises ValueError if any node does not exist.
+        Like NODEDETAILS, the coordinates are raw database values. This
+        always queries the database, even if a snapshot is loaded.'''
+        nids = np.asarray(nids, dtype=int).ravel().tolist()
+        uniq = sorted(set(nids))
+        res = {}
+        for k in range(0, len(uniq), MAXPARAMS):
+            chunk = uniq[k:k+MAXPARAMS]
+            marks = ','.join('?' * len(chunk))
+            for row in self.fetch(f'''select nid, tid, typ, x, y, z, cdate, uid
+                                  from nodes where nid in ({marks})''',
+                                  chunk):
+                res[row[0]] = Node(*row)
+        for n in nids:
+            if n not in res:
+                raise ValueError(f'No such node: {n}')
+        return [ res[n] for n in nids ]
+
     def somaxyz(self, tid):
         '''SOMAXYZ - Get soma location and node ID
         (x, y, z, nid) = SOMAXYZ(tid) returns the soma location and node ID
         for the given tree.'''
-        x,y,z,nid = self.nodexyz(f'tid={tid} and typ=1')
+        if self.snap is not None:
+            x,y,z,nid = self.snap.nodexyz(tid=tid, typ=1)
+        else:
+            x,y,z,nid = self.nodexyz(Filter(tid=tid, typ=1))
         if len(x):
             return x[0], y[0], z[0], nid[0]
         else:
@@ -141,17 +1030,186 @@ class SBEMDB:
         given WHERE clause. For instance, nnn = db.nodes('tid==444 and typ==6')
         finds all the postsynaptic terminals on tree #444.
         Result is a map from nid to class Node.
-        If WHERE is not given, returns all nodes.'''
-        if where!='':
-            where = f'where {where}'
+        If WHERE is not given, returns all nodes. WHERE may also be a
+        FILTER. This always queries the database, even if a snapshot is
+        loaded, because the snapshot does not hold raw coordinates, CDATE,
+        or UID.'''
+        clause, params = self._clause(where)
+        if clause!='':
+            clause = f'where {clause}'
         res = {}
-        query = f'select nid, tid, typ, x, y, z, cdate, uid from nodes {where}'
-        for row in self.fetch(query):
+        query = f'select nid, tid, typ, x, y, z, cdate, uid from nodes {clause}'
+        for row in self.fetch(query, params):
             res[row[0]] = Node(row[0], row[1], row[2],
                                row[3], row[4], row[5],
                                row[6], row[7])
         return res
         
+    def treenodes(self, tid):
+        '''TREENODES - All nodes of a tree
+        rec = TREENODES(tid) returns a record array with fields nid, typ,
+        x, y, z for all the nodes of the given tree, in order of node ID.
+        Coordinates are in microns.'''
+        if self.snap is not None:
+            return self.snap.treenodes(tid)
+        rec = self.fetcharray('''select nid, typ, x, y, z from nodes
+                              where tid=? order by nid''',
+                              [('nid', int), ('typ', int),
+                               ('x', float), ('y', float), ('z', float)],
+                              (int(tid),))
+        return np.rec.fromarrays((rec['nid'], rec['typ'],
+                                  self.pixtoum(rec['x']),
+                                  self.pixtoum(rec['y']),
+                                  self.slicetoum(rec['z'])),
+                                 names='nid,typ,x,y,z')
+
+    def treecons(self, tid):
+        '''TREECONS - All edges of a tree
+        rec = TREECONS(tid) returns a record array with fields ncid, nid1,
+        nid2 for all the node connections within the given tree, in order
+        of ncid. Each connection is listed only once, with NID1 < NID2.'''
+        if self.snap is not None:
+            return self.snap.treecons(tid)
+        rec = self.fetcharray('''select nc.ncid, nc.nid1, nc.nid2
+                              from nodecons as nc
+                              inner join nodes as a on nc.nid1==a.nid
+                              inner join nodes as b on nc.nid2==b.nid
+                              where a.tid=?1 and b.tid=?1
+                              and nc.nid1<nc.nid2 order by nc.ncid''',
+                              [('ncid', int), ('nid1', int), ('nid2', int)],
+                              (int(tid),))
+        return rec.view(np.recarray)
+
+    def treeof(self, nid):
+        '''TREEOF - Tree ID of a node
+        tid = TREEOF(nid) returns the ID of the tree that contains the given
+        node. Raises KeyError if there is no such node.'''
+        if self.snap is not None:
+            return int(self.snap.tid[self.snap.rows(nid)])
+        rows = self.fetch('select tid from nodes where nid=?', (int(nid),))
+        if len(rows) != 1:
+            raise KeyError(f'Node {nid} not found')
+        return rows[0][0]
+
+    def treeIndex(self, tid):
+        '''TREEINDEX - Path-distance index for a tree
+        idx = TREEINDEX(tid) returns a TREEINDEX (see the treeindex module)
+        for the given tree, rooted at its soma. The index is built on first
+        use and kept for subsequent calls until the database is modified.'''
+        self._validateindices()
+        return self._cached(self.indices, tid,
+                            lambda: treeindex.TreeIndex(self, tid))
+
+    def pathDistance(self, nid1, nid2):
+        '''PATHDISTANCE - Distance along tree between two nodes
+        d = PATHDISTANCE(nid1, nid2) returns the length (in microns) of the
+        path along the tree between the given nodes, which must be on the
+        same tree. The result is infinite if there is no such path.
+        This uses TREEINDEX, so after the first call for a given tree,
+        each call takes constant time.'''
+        return self.treeIndex(self.treeof(nid1)).pathDistance(nid1, nid2)
+
+    def pathDistances(self, nids1, nids2):
+        '''PATHDISTANCES - Matrix of distances along a tree
+        dd = PATHDISTANCES(nids1, nids2) returns a matrix of the lengths
+        (in microns) of the paths along the tree between each of the nodes
+        in NIDS1 and each of the nodes in NIDS2. All nodes must be on the
+        same tree.'''
+        tid = self.treeof(np.atleast_1d(nids1)[0])
+        return self.treeIndex(tid).pathDistances(nids1, nids2)
+
+    def spatialIndex(self, tid=None):
+        '''SPATIALINDEX - Spatial index over node positions
+        (gi, nids) = SPATIALINDEX(tid) returns a GRIDINDEX (see the spatial
+        module) over the positions (in microns) of all the nodes of the
+        given tree, as well as the IDs of those nodes, such that indices
+        returned by GI's methods are indices into NIDS. If TID is None,
+        the index covers all nodes in the database.
+        The index is built on first use (from the snapshot, if one is
+        loaded) and kept for subsequent calls until the database is
+        modified.'''
+        self._validateindices()
+        return self._cached(self.grids, tid, lambda: self._buildgrid(tid))
+
+    def _buildgrid(self, tid):
+        if self.snap is not None:
+            if tid is None:
+                rr = np.arange(len(self.snap.nid))
+            else:
+                rr = self.snap.treerows(tid)
+            x = self.snap.x[rr]
+            y = self.snap.y[rr]
+            z = self.snap.z[rr]
+            nids = self.snap.nid[rr]
+        elif tid is None:
+            x, y, z, nids = self.nodexyz()
+        else:
+            x, y, z, nids = self.nodexyz(Filter(tid=tid))
+        gi = spatial.GridIndex(np.stack((x, y, z), 1))
+        return (gi, nids)
+
+    def _allowednids(self, where):
+        # IDs of nodes that satisfy WHERE
+        keep = self._snapmask(where)
+        if keep is not None:
+            return self.snap.nid[keep]
+        clause, params = self._clause(where)
+        return self.fetcharray(f'select nid from nodes where {clause}',
+                               [('nid', int)], params)['nid']
+
+    def _nodefilter(self, nids, dists, where):
+        if not where:
+            return nids, dists
+        keep = np.isin(nids, self._allowednids(where))
+        return nids[keep], dists[keep]
+
+    def nodesNear(self, xyz, r, where=''):
+        '''NODESNEAR - Nodes near a point
+        (nids, dists) = NODESNEAR(xyz, r) returns the IDs of all the nodes
+        that lie within distance R of the point XYZ, as well as their
+        distances, sorted by distance. XYZ and R are in microns.
+        Optional argument WHERE is an SQL clause on the NODES table that
+        restricts which nodes are returned, e.g., 'tid==444 and typ==6',
+        or a FILTER such as Filter(tid=444, typ=6).
+        Raises ValueError if XYZ is not finite.'''
+        gi, allnids = self.spatialIndex()
+        ii, dd = gi.within(xyz, r)
+        return self._nodefilter(allnids[ii], dd, where)
+
+    def nodesNearMany(self, xyz, r, where=''):
+        '''NODESNEARMANY - Nodes near many points
+        res = NODESNEARMANY(xyz, r, where), where XYZ is an Nx3 array,
+        returns a list of N (nids, dists) tuples, one for each point,
+        as from NODESNEAR. Raises ValueError if any point is not finite.'''
+        gi, allnids = self.spatialIndex()
+        res = gi.withinMany(xyz, r)
+        if not where:
+            return [ (allnids[ii], dd) for ii, dd in res ]
+        # Look up the allowed nodes once, as a mask on the index
+        allowed = np.isin(allnids, self._allowednids(where))
+        return [ (allnids[ii[keep]], dd[keep])
+                 for ii, dd in res for keep in [allowed[ii]] ]
+
+    def nearestNodes(self, xyz, k=1, tid=None):
+        '''NEARESTNODES - Nodes nearest to a point
+        (nids, dists) = NEARESTNODES(xyz, k) returns the IDs of the K nodes
+        nearest to the point XYZ, as well as their distances, sorted by
+        distance. XYZ is in microns.
+        Optional argument TID restricts the search to the given tree.
+        Raises ValueError if XYZ is not finite.'''
+        gi, allnids = self.spatialIndex(tid)
+        ii, dd = gi.nearest(xyz, k)
+        return allnids[ii], dd
+
+    def nearestNodesMany(self, xyz, k=1, tid=None):
+        '''NEARESTNODESMANY - Nodes nearest to many points
+        (nids, dists) = NEARESTNODESMANY(xyz, k, tid), where XYZ is an Nx3
+        array, returns NxK arrays of node IDs and distances, as from
+        NEARESTNODES.'''
+        gi, allnids = self.spatialIndex(tid)
+        ii, dd = gi.nearestMany(xyz, k)
+        return allnids[ii], dd
+
     def pixtoum(self, x, a=0):
         return x * .0055 * 2.**a
 
@@ -173,10 +1231,27 @@ class SBEMDB:
         where SYNCNT is a count of synapses from each tree to the target
         and TNAME is the name of the tree.
         PRESYNTREES(tid, clause) where CLAUSE is a SQL where clause in terms
-        of, e.g., trees.tname adds additional constraints. '''
-        clause = f'b.tid={tid}'
-        if where != '':
-            clause += f' and ({where})'
+        of, e.g., trees.tname adds additional constraints. CLAUSE may also
+        be a FILTER in terms of tname and pretid. If a snapshot is loaded
+        and the filter only uses pretid, the synapses are counted in the
+        snapshot.'''
+        keep = self._snapmask(where, lambda snap: { 'pretid':
+                                                    snap.tid[snap.synpre] })
+        if keep is not None:
+            keep &= self.snap.tid[self.snap.synpost] == tid
+            tids, cnts = np.unique(self.snap.tid[self.snap.synpre[keep]],
+                                   return_counts=True)
+            clause, params = Filter(tid=tids).sql()
+            names = dict(self.fetch(f'select tid, tname from trees where {clause}',
+                                    params))
+            return { int(t): (int(c), names[t]) for t, c in zip(tids, cnts) }
+        clause, params = self._clause(where, { 'tname': 'trees.tname',
+                                               'pretid': 'a.tid' })
+        params = [int(tid)] + params
+        if clause != '':
+            clause = f'b.tid=? and ({clause})'
+        else:
+            clause = 'b.tid=?'
 
         query = f'''select a.tid, count(1) as cnt, tname
         from nodes as a
@@ -188,11 +1263,114 @@ class SBEMDB:
         where ({clause}) and a.typ==5 and b.typ==6
         group by a.tid'''
         res = {}
-        for row in self.fetch(query):
+        for row in self.fetch(query, params):
             res[row[0]] = (row[1], row[2])
         return res
 
-    def simplesegments(self, where):
+    def connectivity(self, pre_where='', post_where='', weight=None):
+        '''CONNECTIVITY - Matrix of synapse counts between trees
+        (mat, pretids, posttids) = CONNECTIVITY() returns a sparse matrix
+        (scipy.sparse.csr_matrix) of synapse counts between all trees:
+        MAT[i, j] is the number of synapses from tree PRETIDS[i] onto tree
+        POSTTIDS[j]. PRETIDS and POSTTIDS list, in increasing order, the
+        trees that have at least one outgoing or incoming synapse. As in
+        PRESYNTREES, synapses are counted as pairs of presynaptic and
+        postsynaptic nodes, so that MAT[:, j] matches PRESYNTREES(tid)
+        for TID = POSTTIDS[j].
+        Optional arguments PRE_WHERE and POST_WHERE restrict the
+        presynaptic and postsynaptic sides. Each may be an SQL clause
+        in terms of the tables used by SYNAPSES (e.g., 'pre.tname like
+        "DI%"' or 'b.typ==6'), or a FILTER in terms of tid, tname, and
+        nid of the respective side.
+        Optional argument WEIGHT is a dict mapping synapse IDs to weights
+        (e.g., the result of CERTAINTIES.UNCERTAINTIES). MAT then contains
+        sums of weights rather than counts. Synapses not in WEIGHT have
+        weight zero.
+        All counts are computed with a single grouped query, or directly
+        from the snapshot if one is loaded and PRE_WHERE and POST_WHERE
+        are empty or FILTERs in terms of tid and nid.'''
+        import scipy.sparse
+        rec = self._snapconnectivity(pre_where, post_where)
+        if rec is None:
+            pre, prm1 = self._clause(pre_where, { 'tid': 'pre.tid',
+                                                  'tname': 'pre.tname',
+                                                  'nid': 'a.nid' })
+            post, prm2 = self._clause(post_where, { 'tid': 'post.tid',
+                                                    'tname': 'post.tname',
+                                                    'nid': 'b.nid' })
+            clause = 'a.typ==5 and b.typ==6'
+            if pre != '':
+                clause += f' and ({pre})'
+            if post != '':
+                clause += f' and ({post})'
+            if weight is None:
+                cols = 'pre.tid, post.tid, 0, count(1)'
+                grp = 'pre.tid, post.tid'
+            else:
+                cols = 'pre.tid, post.tid, s.sid, count(1)'
+                grp = 'pre.tid, post.tid, s.sid'
+            query = f'''select {cols}
+                from trees as pre
+                inner join nodes as a on pre.tid==a.tid
+                inner join syncons as sca on a.nid==sca.nid
+                inner join synapses as s on sca.sid==s.sid
+                inner join syncons as scb on scb.sid==s.sid
+                inner join nodes as b on scb.nid==b.nid
+                inner join trees as post on b.tid==post.tid
+                where {clause} group by {grp}'''
+            rec = self.fetcharray(query,
+                                  [('pretid', int), ('posttid', int),
+                                   ('sid', int), ('cnt', int)],
+                                  prm1 + prm2)
+        if weight is None:
+            val = rec['cnt']
+        else:
+            wsid = np.fromiter(weight.keys(), dtype=int, count=len(weight))
+            wval = np.fromiter(weight.values(), dtype=float,
+                               count=len(weight))
+            order = np.argsort(wsid)
+            wsid = wsid[order]
+            wval = wval[order]
+            k = np.minimum(np.searchsorted(wsid, rec['sid']),
+                           max(len(wsid) - 1, 0))
+            if len(wsid):
+                w = np.where(wsid[k]==rec['sid'], wval[k], 0)
+            else:
+                w = np.zeros(len(rec))
+            val = rec['cnt'] * w
+        pretids, ii = np.unique(rec['pretid'], return_inverse=True)
+        posttids, jj = np.unique(rec['posttid'], return_inverse=True)
+        mat = scipy.sparse.coo_matrix((val, (ii, jj)),
+                                      shape=(len(pretids), len(posttids)))
+        return mat.tocsr(), pretids, posttids
+
+    def _snapconnectivity(self, pre_where, post_where):
+        # Rows (pretid, posttid, sid, cnt) for CONNECTIVITY from the
+        # snapshot, one per synapse node pair, or None if that cannot be
+        # done.
+        if self.snap is None:
+            return None
+        keep = np.ones(len(self.snap.synsid), dtype=bool)
+        for where, rows in [(pre_where, self.snap.synpre),
+                            (post_where, self.snap.synpost)]:
+            if isinstance(where, Filter):
+                try:
+                    keep &= where.mask({ 'tid': self.snap.tid[rows],
+                                         'nid': self.snap.nid[rows] })
+                except KeyError:
+                    return None
+            elif where != '':
+                return None
+        rec = np.zeros(np.count_nonzero(keep),
+                       dtype=[('pretid', int), ('posttid', int),
+                              ('sid', int), ('cnt', int)])
+        rec['pretid'] = self.snap.tid[self.snap.synpre[keep]]
+        rec['posttid'] = self.snap.tid[self.snap.synpost[keep]]
+        rec['sid'] = self.snap.synsid[keep]
+        rec['cnt'] = 1
+        return rec
+
+    def simplesegments(self, where, asrecord=False):
         '''SIMPLESEGMENTS - Get coordinates of a tree
         segs = SIMPLESEGMENTS(tid) returns all segments of a tree. TID must
         be a numeric tree ID.
@@ -200,29 +1378,84 @@ class SBEMDB:
         CLAUSE should be a WHERE clause that specifies a tree, for
         instance, 'nodes.tid==444'.
         SEGS will be a Nx6 matrix of (x1,y1,z1,x2,y2,z2) coordinates.
-        Coordinates are returned in microns.'''
-        if not (type(where)==str):
-            clause = f'a.tid={where}'
-        else:
-            clause = f'({where})'
+        Coordinates are returned in microns.
+        CLAUSE may also be a FILTER in terms of tid, typ, and nid (of the
+        lower-numbered node of each segment).
+        Optional argument ASRECORD makes the result a numpy record array
+        with fields x1, y1, z1, x2, y2, z2 instead.
+        If a snapshot is loaded, a tree ID or FILTER is evaluated against
+        the snapshot rather than the database.'''
+        if not isinstance(where, (str, Filter)):
+            where = Filter(tid=int(where))
+        names = ['x1', 'y1', 'z1', 'x2', 'y2', 'z2']
+        keep = self._snapedgemask(where)
+        if keep is not None:
+            a = self.snap.edge1[keep]
+            b = self.snap.edge2[keep]
+            cols = [self.snap.x[a], self.snap.y[a], self.snap.z[a],
+                    self.snap.x[b], self.snap.y[b], self.snap.z[b]]
+            if asrecord:
+                return np.rec.fromarrays(cols, names=names)
+            return np.column_stack(cols)
+        clause, params = self._clause(where, { 'tid': 'a.tid',
+                                               'typ': 'a.typ',
+                                               'nid': 'a.nid' })
         query = f'''select a.x as ax, a.y as ay, a.z as az,
             b.x as bx,b.y as by,b.z as bz
             from nodes as a
             inner join nodecons as nc on a.nid==nc.nid1
             inner join nodes as b on nc.nid2==b.nid
             where a.nid<b.nid and ({clause})'''
-        rows = self.fetch(query)
-        K = len(rows)
-        res = np.zeros((K, 6))
-        for k in range(K):
-            res[k,:] = np.array(rows[k])
-        for c in [0, 1, 3, 4]:
-            res[:,c] = self.pixtoum(res[:,c])
-        for c in [2, 5]:
-            res[:,c] = self.slicetoum(res[:,c])
-
-        return res
+        rec = self.fetcharray(query, [(n, float) for n in names], params)
+        cols = [self.pixtoum(rec['x1']), self.pixtoum(rec['y1']),
+                self.slicetoum(rec['z1']),
+                self.pixtoum(rec['x2']), self.pixtoum(rec['y2']),
+                self.slicetoum(rec['z2'])]
+        if asrecord:
+            return np.rec.fromarrays(cols, names=names)
+        return np.column_stack(cols)
     
+    def _segmentrows(self, where):
+        # All edges selected by WHERE (as for SEGMENTS), as a structured
+        # array with fields aid, ax, ay, az, bid, bx, by, bz, with AID < BID,
+        # ordered by AID. Coordinates are in microns.
+        dtype = [('aid', int), ('ax', float), ('ay', float), ('az', float),
+                 ('bid', int), ('bx', float), ('by', float), ('bz', float)]
+        if not isinstance(where, (str, Filter)):
+            where = Filter(tid=int(where))
+        keep = self._snapedgemask(where)
+        if keep is not None:
+            # Rows are in order of node ID
+            a = self.snap.edge1[keep]
+            b = self.snap.edge2[keep]
+            order = np.argsort(a, kind='stable')
+            a = a[order]
+            b = b[order]
+            rec = np.zeros(len(a), dtype=dtype)
+            for k, rows in [('a', a), ('b', b)]:
+                rec[k+'id'] = self.snap.nid[rows]
+                rec[k+'x'] = self.snap.x[rows]
+                rec[k+'y'] = self.snap.y[rows]
+                rec[k+'z'] = self.snap.z[rows]
+            return rec
+        clause, params = self._clause(where, { 'tid': 'nodes.tid',
+                                               'typ': 'nodes.typ',
+                                               'nid': 'nodes.nid' })
+
+        wht = '''nodes.nid as aid,
+           nodes.x as ax, nodes.y as ay, nodes.z as az,
+           b.nid as bid,b.x as bx,b.y as by,b.z as bz'''
+        frm = ''' from nodes inner join nodecons as c on nodes.nid==c.nid1
+           inner join nodes as b on c.nid2==b.nid'''
+        query = f'''select {wht} {frm} 
+            where aid<bid and ({clause}) order by aid'''
+        rec = self.fetcharray(query, dtype, params)
+        for k in 'ab':
+            rec[k+'x'] = self.pixtoum(rec[k+'x'])
+            rec[k+'y'] = self.pixtoum(rec[k+'y'])
+            rec[k+'z'] = self.slicetoum(rec[k+'z'])
+        return rec
+
     def segments(self, where):
         '''SEGMENTS - Get coordinates of a tree
         (xx, yy, zz) = SEGMENTS(tid) returns all segments of a tree. TID must
@@ -232,51 +1465,56 @@ class SBEMDB:
         instance, 'nodes.tid==444'.
         Results XX, YY, ZZ can be used directly for plotting.
         Coordinates are returned in microns;
-        breaks in the data are marked by NANs.'''
-        if not (type(where)==str):
-            clause = f'nodes.tid={where}'
-        else:
-            clause = f'({where})'
-		
-        c = self.db.cursor()
-        wht = '''nodes.nid as aid,
-           nodes.x as ax, nodes.y as ay, nodes.z as az,
-           b.nid as bid,b.x as bx,b.y as by,b.z as bz'''
-        frm = ''' from nodes inner join nodecons as c on nodes.nid==c.nid1
-           inner join nodes as b on c.nid2==b.nid'''
-        query = f'''select {wht} {frm} 
-            where aid<bid and ({clause}) order by aid'''
-        xx = []
-        yy = []
-        zz = []
-        lastid = None
-        for row in self.fetch(query):
-            aid = row[0]
-            ax = row[1]
-            ay = row[2]
-            az = row[3]
-            bid = row[4]
-            bx = row[5]
-            by = row[6]
-            bz = row[7]
-            if aid != lastid:
-                if lastid is not None:
-                    xx.append(np.nan)
-                    yy.append(np.nan)
-                    zz.append(np.nan)
-                xx.append(ax)
-                yy.append(ay)
-                zz.append(az)
-            xx.append(bx)
-            yy.append(by)
-            zz.append(bz)
-            lastid = bid
-        xx = self.pixtoum(np.array(xx))
-        yy = self.pixtoum(np.array(yy))
-        zz = self.slicetoum(np.array(zz))
-        return (xx, yy, zz)      
-
-    def synapses(self, where='', extended=False):
+        breaks in the data are marked by NANs.
+        CLAUSE may also be a FILTER in terms of tid, typ, and nid. If a
+        snapshot is loaded, a tree ID or FILTER is evaluated against the
+        snapshot rather than the database.
+        See also SEGMENTARRAY and SEGMENTINDICES.'''
+        rec = self._segmentrows(where)
+        N = len(rec)
+        # An edge continues the polyline if its first node is the second
+        # node of the previous edge. Otherwise, a new polyline starts,
+        # which takes a NaN (except at the very beginning) plus the first
+        # node, in addition to the second node that every edge adds.
+        start = np.ones(N, dtype=bool)
+        start[1:] = rec['aid'][1:] != rec['bid'][:-1]
+        brk = start.copy()
+        brk[:1] = False
+        end = np.cumsum(1 + start + brk) - 1
+        xyz = []
+        for c in 'xyz':
+            out = np.full(end[-1] + 1 if N else 0, np.nan)
+            out[end] = rec['b' + c]
+            out[end[start] - 1] = rec['a' + c][start]
+            xyz.append(out)
+        return tuple(xyz)
+
+    def segmentarray(self, where):
+        '''SEGMENTARRAY - Get coordinates of a tree as line segments
+        segs = SEGMENTARRAY(where) returns the same edges as SEGMENTS, as
+        an Mx2x3 array of end points, in microns. This is the format used
+        by matplotlib's LineCollection and Line3DCollection.'''
+        rec = self._segmentrows(where)
+        return np.stack((np.stack((rec['ax'], rec['ay'], rec['az']), 1),
+                         np.stack((rec['bx'], rec['by'], rec['bz']), 1)), 1)
+
+    def segmentindices(self, where):
+        '''SEGMENTINDICES - Get a tree as vertices and an index buffer
+        (xyz, idx, nids) = SEGMENTINDICES(where) returns the same edges as
+        SEGMENTS in the format used by 3D viewers: XYZ is a Vx3 array of
+        the positions (in microns) of the nodes involved, IDX is an Mx2
+        array of indices into XYZ, one row for each edge, and NIDS holds
+        the IDs of the nodes in XYZ, in increasing order.'''
+        rec = self._segmentrows(where)
+        ids = np.concatenate((rec['aid'], rec['bid']))
+        nids, first, inv = np.unique(ids, return_index=True,
+                                     return_inverse=True)
+        xyz = np.stack((np.concatenate((rec['ax'], rec['bx'])),
+                        np.concatenate((rec['ay'], rec['by'])),
+                        np.concatenate((rec['az'], rec['bz']))), 1)[first]
+        return xyz, inv.reshape(2, -1).T.copy(), nids
+
+    def synapses(self, where='', extended=False, asrecord=False):
         '''SYNAPSES - Find position of synapses
         (xx, yy, zz, pretid, posttid) = SYNAPSES(where) returns the 
         coordinates and pre- and postsynaptic tree IDs of synapses.
@@ -290,10 +1528,34 @@ class SBEMDB:
         at least one postsynaptic terminal.
         EXTENDED tells if synapse ids, presynaptic and postsynaptic node ids
         should be added to output. In that case, the return value is
-        (xx, yy, zz, pretid, posttid, sid, prenid, postnid).'''
-        clause = f'a.typ==5 and b.typ==6'
-        if where != '': 
-            clause += f' and ({where})'
+        (xx, yy, zz, pretid, posttid, sid, prenid, postnid).
+        ASRECORD makes the result a numpy record array with fields x, y, z,
+        pretid, posttid, sid, prenid, and postnid instead of a tuple.
+        WHERE may also be a FILTER in terms of those same field names,
+        e.g., Filter(posttid=444). If a snapshot is loaded, a FILTER in
+        terms of pretid, posttid, sid, prenid, and postnid is evaluated
+        against the snapshot rather than the database.'''
+        keep = self._snapmask(where, lambda snap: snap.syncolumns())
+        if keep is not None:
+            output = self.snap.synapses(keep, extended or asrecord)
+            if asrecord:
+                return np.rec.fromarrays(output, names='x,y,z,pretid,posttid,'
+                                         + 'sid,prenid,postnid')
+            return output
+        rec = self.fetcharray(*self._synapsequery(where))
+        return self._synapseresult(rec, extended, asrecord)
+
+    def _synapsequery(self, where):
+        # Query, dtype, and parameters for SYNAPSES
+        clause, params = self._clause(where, { 'pretid': 'pre.tid',
+                                               'posttid': 'post.tid',
+                                               'sid': 's.sid',
+                                               'prenid': 'a.nid',
+                                               'postnid': 'b.nid' })
+        if clause != '':
+            clause = f'a.typ==5 and b.typ==6 and ({clause})'
+        else:
+            clause = 'a.typ==5 and b.typ==6'
 
         query = f'''select a.x as ax, a.y as ay, a.z as az,
                 b.x as bx, b.y as by, b.z as bz,
@@ -307,34 +1569,42 @@ class SBEMDB:
                 inner join nodes as b on scb.nid==b.nid
                 inner join trees as post on b.tid==post.tid
                 where {clause}'''
-        
-        rows = self.fetch(query)
-        N = len(rows)
-        xx = np.zeros(N)
-        yy = np.zeros(N)
-        zz = np.zeros(N)
-        pretid = np.zeros(N, dtype=int)
-        posttid = np.zeros(N, dtype=int)
-        synid = np.zeros(N, dtype=int)
-        prenid = np.zeros(N, dtype=int)
-        postnid = np.zeros(N, dtype=int)
-        for n in range(N):
-            row = rows[n]
-            xx[n] = (row[0]+row[3])/2.0
-            yy[n] = (row[1]+row[4])/2.0
-            zz[n] = (row[2]+row[5])/2.0
-            pretid[n] = row[6]
-            posttid[n] = row[7]
-            synid[n] = row[8]
-            prenid[n] = row[9]
-            postnid[n] = row[10]
-        xx = self.pixtoum(xx)
-        yy = self.pixtoum(yy)
-        zz = self.slicetoum(zz)
+        return (query,
+                [('ax', float), ('ay', float), ('az', float),
+                 ('bx', float), ('by', float), ('bz', float),
+                 ('pretid', int), ('posttid', int),
+                 ('sid', int),
+                 ('prenid', int), ('postnid', int)],
+                params)
+
+    def _synapseresult(self, rec, extended, asrecord):
+        xx = self.pixtoum((rec['ax'] + rec['bx'])/2.0)
+        yy = self.pixtoum((rec['ay'] + rec['by'])/2.0)
+        zz = self.slicetoum((rec['az'] + rec['bz'])/2.0)
+        pretid = rec['pretid']
+        posttid = rec['posttid']
+        synid = rec['sid']
+        prenid = rec['prenid']
+        postnid = rec['postnid']
+        if asrecord:
+            return np.rec.fromarrays((xx, yy, zz, pretid, posttid,
+                                      synid, prenid, postnid),
+                                     names='x,y,z,pretid,posttid,'
+                                     + 'sid,prenid,postnid')
         output = (xx, yy, zz, pretid, posttid)
         if extended:
             output += (synid, prenid, postnid)
         return output
+
+    def itersynapses(self, where='', extended=False, chunk=100000,
+                     asrecord=False):
+        '''ITERSYNAPSES - Find position of synapses in chunks
+        for (xx, yy, zz, pretid, posttid) in ITERSYNAPSES(where, chunk): ...
+        iterates over the results of SYNAPSES(where) in chunks of at most
+        CHUNK synapses, so that even a query over all synapses runs in
+        constant memory. EXTENDED and ASRECORD are as for SYNAPSES.'''
+        for rec in self.iterfetch(*self._synapsequery(where), chunk=chunk):
+            yield self._synapseresult(rec, extended, asrecord)
     
     def distanceAlongTree(self, nid):
         '''DISTANCEALONGTREE - Distance along tree between nodes
@@ -345,22 +1615,25 @@ class SBEMDB:
         list.
         See example of use in demo.py.'''
 
+        if self.snap is not None:
+            return self.snap.distanceAlongTree(nid)
+
         islist = type(nid)==list or type(nid)==np.ndarray or type(nid)==tuple
         if islist:
             nid0 = nid[0]
         else:
             nid0 = nid
             
-        res = self.fetch(f'select tid from nodes where nid={nid0}')
+        res = self.fetch('select tid from nodes where nid=?', (int(nid0),))
         if len(res) != 1:
             raise KeyError(f'Node {nid0} not found')
         tid = res[0][0]
-        res = self.fetch(f'''select
+        res = self.fetch('''select
            n1.x, n1.y, n1.z, n1.nid, n2.x, n2.y, n2.z, n2.nid
            from nodes as n1
            inner join nodecons as s on n1.nid=s.nid1
            inner join nodes as n2 on n2.nid=s.nid2
-           where n1.nid<n2.nid and n1.tid={tid}''')
+           where n1.nid<n2.nid and n1.tid=?''', (tid,))
         neighbors = {}
         # NEIGHBORS will be a map from nid to a dict of (nid: distance) pairs
         facxy = self.pixtoum(1)**2
@@ -409,44 +1682,15 @@ class SBEMDB:
     def pathBetweenNodes(self, node1, node2):
         '''PATHBETWEENNODES - Sequence of nodes between given nodes
         nids = PATHBETWEENNODSE(nid1, nid2) returns a list of all the nodes
-        on the path between the given end nodes, including those end nodes.'''
-        rows = self.fetch(f'''select tid from nodes
-                          where nid=={node1} limit 1''')
-        tid = rows[0][0]
-
-        all_dist = self.distanceAlongTree(node2)
-
-        rows = self.fetch(f'''select nc.nid1, nc.nid2 from nodecons as nc
-                          inner join nodes as n on nc.nid2==n.nid 
-                          where n.tid=={tid}''')
-        all_cons = {}
-        for nid1, nid2 in rows:
-            if nid1 not in all_cons:
-                all_cons[nid1] = []
-            all_cons[nid1].append(nid2)
-
-        path = [node1]
-        while path[-1] != node2:
-            here = path[-1]
-            dst = all_dist[here]
-            nxt = None
-            for nxt1 in all_cons[here]:
-                if all_dist[nxt1] < dst:
-                    if nxt is None:
-                        nxt = nxt1
-                    else:
-                        raise Exception('Double path!?')
-            if nxt is None:
-                raise Exception('No path!?')
-            path.append(nxt)
-        return path
-    
+        on the path between the given end nodes, including those end nodes.
+        This uses TREEINDEX rather than searching the tree.'''
+        return self.treeIndex(self.treeof(node1)).path(node1, node2)
+
     def nodeToEdgeDistance(self, nid, nid1, nid2):
         '''NODETOEDGEDISTANCE - Distance between node and an edge 
         NODETOEDGEDISTANCE(nid, nid1, nid2) returns the distance between 
         the node defined by NID and the EDGE defined by the two nodes 
         NID1 and NID2. The result is expressed in microns.'''
-        p = self.onenodexyz(nid)
-        p1 = self.onenodexyz(nid1)
-        p2 = self.onenodexyz(nid2)
+        x, y, z = self.nodexyzMany([nid, nid1, nid2])
+        p, p1, p2 = np.stack((x, y, z), 1)
         return LineSegmentGeom.pointDistance(p, p1, p2)
@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+
+import numpy as np
+import json
+import os
+import shutil
+
+class Snapshot:
+    '''SNAPSHOT - In-memory columnar copy of an SBEMDB
+
+    snap = SNAPSHOT(db) loads the nodes, node connections, and synapses
+    of the given SBEMDB into numpy arrays, so that repeated queries become
+    array lookups rather than SQL round trips. Normally, you would not
+    construct a SNAPSHOT directly, but call db.snapshot().
+
+    The snapshot contains the following tables:
+
+    - Nodes, sorted by node ID:
+        NID, TID, TYP - node ID, tree ID, and node type of each node
+        X, Y, Z - node positions in microns
+    - Edges, one for each NODECON with NID1 < NID2 that connects two nodes
+      on the same tree:
+        NCID - nodecon ID
+        EDGE1, EDGE2 - row indices into the node table of the end points
+    - Adjacency, in compressed sparse row format, listing each edge in
+      both directions:
+        INDPTR, INDICES, WEIGHTS - The neighbors of the node in row K
+        are in rows INDICES[INDPTR[K]:INDPTR[K+1]]. Their distances (in
+        microns) are in WEIGHTS[INDPTR[K]:INDPTR[K+1]].
+    - Synapses, one for each pair of presynaptic and postsynaptic nodes:
+        SYNSID - synapse ID
+        SYNPRE, SYNPOST - row indices into the node table of the
+        presynaptic and postsynaptic nodes.
+    - Trees:
+        TREEORDER - node rows, sorted by tree ID
+        TREETIDS - sorted list of tree IDs that have nodes
+        TREEPTR - The nodes of tree TREETIDS[K] are in rows
+        TREEORDER[TREEPTR[K]:TREEPTR[K+1]].
+        EDGEORDER, EDGEPTR - Likewise for the edges of each tree.
+
+    Rows are positions in the node table, not node IDs. Use ROWS to
+    convert node IDs to rows.'''
+
+    FIELDS = ['nid', 'tid', 'typ', 'x', 'y', 'z',
+              'ncid', 'edge1', 'edge2',
+              'indptr', 'indices', 'weights',
+              'synsid', 'synpre', 'synpost',
+              'treeorder', 'treetids', 'treeptr',
+              'edgeorder', 'edgeptr']
+
+    def __init__(self, db):
+        '''Snapshot(db) loads the contents of the given SBEMDB.'''
+        rec = db.fetcharray('select nid, tid, typ, x, y, z from nodes'
+                            + ' order by nid',
+                            [('nid', int), ('tid', int), ('typ', int),
+                             ('x', float), ('y', float), ('z', float)])
+        self.nid = rec['nid']
+        self.tid = rec['tid']
+        self.typ = rec['typ']
+        self.x = db.pixtoum(rec['x'])
+        self.y = db.pixtoum(rec['y'])
+        self.z = db.slicetoum(rec['z'])
+
+        rec = db.fetcharray('select ncid, nid1, nid2 from nodecons'
+                            + ' where nid1<nid2 order by ncid',
+                            [('ncid', int), ('nid1', int), ('nid2', int)])
+        ok1, edge1 = self._lookup(rec['nid1'])
+        ok2, edge2 = self._lookup(rec['nid2'])
+        keep = ok1 & ok2
+        keep[keep] = self.tid[edge1[keep]] == self.tid[edge2[keep]]
+        self.ncid = rec['ncid'][keep]
+        self.edge1 = edge1[keep]
+        self.edge2 = edge2[keep]
+
+        rec = db.fetcharray('''select s.sid, a.nid, b.nid
+                from trees as pre
+                inner join nodes as a on pre.tid==a.tid
+                inner join syncons as sca on a.nid==sca.nid
+                inner join synapses as s on sca.sid==s.sid
+                inner join syncons as scb on scb.sid==s.sid
+                inner join nodes as b on scb.nid==b.nid
+                inner join trees as post on b.tid==post.tid
+                where a.typ==5 and b.typ==6''',
+                            [('sid', int), ('prenid', int), ('postnid', int)])
+        self.synsid = rec['sid']
+        self.synpre = self.rows(rec['prenid'])
+        self.synpost = self.rows(rec['postnid'])
+        self._index()
+
+    @classmethod
+    def fromarrays(cls, arrays):
+        '''FROMARRAYS - Reconstruct a snapshot from its arrays
+        snap = FROMARRAYS(arrays), where ARRAYS is a dict containing all
+        the FIELDS of a snapshot, reconstructs the snapshot without
+        touching the database.'''
+        self = cls.__new__(cls)
+        for k in cls.FIELDS:
+            setattr(self, k, arrays[k])
+        return self
+
+    def arrays(self):
+        '''ARRAYS - Dict of all the arrays that make up the snapshot'''
+        return { k: getattr(self, k) for k in self.FIELDS }
+
+    def save(self, cachedir, fingerprint):
+        '''SAVE - Save snapshot to a cache directory
+        SAVE(cachedir, fingerprint) writes all the arrays of the snapshot
+        as .npy files into the given directory, together with the given
+        FINGERPRINT (a dict) that identifies the database they were derived
+        from. The directory is first written under a temporary name and
+        then moved into place, so that concurrent readers never see a
+        partial cache.'''
+        tmpdir = f'{cachedir}.{os.getpid()}.tmp'
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        for k, v in self.arrays().items():
+            np.save(os.path.join(tmpdir, k + '.npy'), v)
+        with open(os.path.join(tmpdir, 'fingerprint.json'), 'w') as fd:
+            json.dump({ 'fields': self.FIELDS, **fingerprint }, fd)
+        if os.path.exists(cachedir):
+            shutil.rmtree(cachedir)
+        os.rename(tmpdir, cachedir)
+
+    @classmethod
+    def load(cls, cachedir, fingerprint):
+        '''LOAD - Load snapshot from a cache directory
+        snap = LOAD(cachedir, fingerprint) loads a snapshot previously
+        written by SAVE. The arrays are memory mapped read-only rather than
+        copied. Returns None if the directory does not exist, is incomplete,
+        or was saved with a different FINGERPRINT.'''
+        try:
+            with open(os.path.join(cachedir, 'fingerprint.json')) as fd:
+                saved = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if saved != { 'fields': cls.FIELDS, **fingerprint }:
+            return None
+        arrays = {}
+        for k in cls.FIELDS:
+            try:
+                arrays[k] = np.load(os.path.join(cachedir, k + '.npy'),
+                                    mmap_mode='r')
+            except (OSError, ValueError):
+                return None
+        return cls.fromarrays(arrays)
+
+    def _index(self):
+        # Adjacency in compressed sparse row format
+        N = len(self.nid)
+        src = np.concatenate((self.edge1, self.edge2))
+        dst = np.concatenate((self.edge2, self.edge1))
+        wei = np.sqrt((self.x[src] - self.x[dst])**2
+                      + (self.y[src] - self.y[dst])**2
+                      + (self.z[src] - self.z[dst])**2)
+        order = np.argsort(src, kind='stable')
+        self.indices = dst[order]
+        self.weights = wei[order]
+        self.indptr = np.zeros(N + 1, dtype=int)
+        np.cumsum(np.bincount(src, minlength=N), out=self.indptr[1:])
+
+        # Grouping of nodes and edges by tree
+        self.treeorder = np.argsort(self.tid, kind='stable')
+        self.treetids = np.unique(self.tid)
+        self.treeptr = np.append(np.searchsorted(self.tid[self.treeorder],
+                                                 self.treetids), N)
+        etid = self.tid[self.edge1]
+        self.edgeorder = np.argsort(etid, kind='stable')
+        self.edgeptr = np.append(np.searchsorted(etid[self.edgeorder],
+                                                 self.treetids), len(etid))
+
+    def _lookup(self, nids):
+        nids = np.asarray(nids, dtype=int)
+        if len(self.nid)==0:
+            return np.zeros(nids.shape, dtype=bool), np.zeros(nids.shape, int)
+        rows = np.minimum(np.searchsorted(self.nid, nids), len(self.nid) - 1)
+        return self.nid[rows] == nids, rows
+
+    def rows(self, nids):
+        '''ROWS - Convert node IDs to rows in the node table
+        rr = ROWS(nids) returns the row indices of the given nodes.
+        NIDS may be a single node ID or an array. Raises KeyError if
+        any of the nodes do not exist.'''
+        ok, rows = self._lookup(nids)
+        if not np.all(ok):
+            missing = np.asarray(nids)[~ok]
+            raise KeyError(f'Node {missing.flat[0]} not found')
+        return rows
+
+    def _treeslot(self, tid):
+        k = np.searchsorted(self.treetids, tid)
+        if k < len(self.treetids) and self.treetids[k]==tid:
+            return k
+        return None
+
+    def treerows(self, tid):
+        '''TREEROWS - Rows of all the nodes of a tree
+        rr = TREEROWS(tid) returns the rows in the node table of all the
+        nodes belonging to the given tree, in order of node ID.'''
+        k = self._treeslot(tid)
+        if k is None:
+            return np.zeros(0, dtype=int)
+        return self.treeorder[self.treeptr[k]:self.treeptr[k+1]]
+
+    def treeedges(self, tid):
+        '''TREEEDGES - Indices of all the edges of a tree
+        ee = TREEEDGES(tid) returns indices into the edge table of all
+        the edges belonging to the given tree, in order of nodecon ID.'''
+        k = self._treeslot(tid)
+        if k is None:
+            return np.zeros(0, dtype=int)
+        return self.edgeorder[self.edgeptr[k]:self.edgeptr[k+1]]
+
+    def nodexyz(self, tid=None, typ=None, nid=None):
+        '''NODEXYZ - Get a map of node location
+        (x, y, z, nid) = NODEXYZ(tid=..., typ=..., nid=...) returns the
+        locations of all nodes that match the given tree IDs, node types,
+        and node IDs. Each may be a single value or a list. Unspecified
+        criteria are not used for selection. The result is as for
+        SBEMDB.NODEXYZ.'''
+        keep = np.ones(len(self.nid), dtype=bool)
+        for col, val in [(self.tid, tid), (self.typ, typ), (self.nid, nid)]:
+            if val is not None:
+                keep &= np.isin(col, val)
+        return (self.x[keep], self.y[keep], self.z[keep], self.nid[keep])
+
+    def syncolumns(self):
+        '''SYNCOLUMNS - Columns of the synapse table
+        cols = SYNCOLUMNS() returns a dict with the pre- and postsynaptic
+        tree IDs (PRETID, POSTTID) and node IDs (PRENID, POSTNID) and the
+        synapse ID (SID) of each synapse, in the form used by FILTER.MASK.'''
+        return { 'pretid': self.tid[self.synpre],
+                 'posttid': self.tid[self.synpost],
+                 'prenid': self.nid[self.synpre],
+                 'postnid': self.nid[self.synpost],
+                 'sid': self.synsid }
+
+    def synapses(self, keep=None, extended=False):
+        '''SYNAPSES - Find position of synapses
+        (xx, yy, zz, pretid, posttid) = SYNAPSES(keep) returns the
+        coordinates and pre- and postsynaptic tree IDs of the synapses
+        selected by the boolean array KEEP, or of all synapses if KEEP is
+        None. EXTENDED has the same meaning as for SBEMDB.SYNAPSES.'''
+        pre = self.synpre
+        post = self.synpost
+        sid = self.synsid
+        if keep is not None:
+            pre = pre[keep]
+            post = post[keep]
+            sid = sid[keep]
+        output = ((self.x[pre] + self.x[post]) / 2.0,
+                  (self.y[pre] + self.y[post]) / 2.0,
+                  (self.z[pre] + self.z[post]) / 2.0,
+                  self.tid[pre], self.tid[post])
+        if extended:
+            output += (sid, self.nid[pre], self.nid[post])
+        return output
+
+    def treenodes(self, tid):
+        '''TREENODES - All nodes of a tree
+        rec = TREENODES(tid) returns a record array with fields nid, typ,
+        x, y, z for all the nodes of the given tree.'''
+        rr = self.treerows(tid)
+        return np.rec.fromarrays((self.nid[rr], self.typ[rr],
+                                  self.x[rr], self.y[rr], self.z[rr]),
+                                 names='nid,typ,x,y,z')
+
+    def treecons(self, tid):
+        '''TREECONS - All edges of a tree
+        rec = TREECONS(tid) returns a record array with fields ncid, nid1,
+        nid2 for all the edges of the given tree. NID1 < NID2 always.'''
+        ee = self.treeedges(tid)
+        return np.rec.fromarrays((self.ncid[ee],
+                                  self.nid[self.edge1[ee]],
+                                  self.nid[self.edge2[ee]]),
+                                 names='ncid,nid1,nid2')
+
+    def traverse(self, rows):
+        '''TRAVERSE - Breadth-first traversal of a tree
+        (dist, parent) = TRAVERSE(rows) performs a breadth-first traversal
+        starting from the nodes in the given rows. DIST is an array that
+        contains the distance along the tree (in microns) from the nearest
+        start node for every node in the database. (Nodes that cannot be
+        reached have distance infinity.) PARENT is an array containing
+        the row of the neighboring node through which each node was
+        reached, or -1 for start nodes and unreachable nodes.'''
+        N = len(self.nid)
+        dist = np.full(N, np.inf)
+        parent = np.full(N, -1)
+        frontier = np.unique(rows)
+        dist[frontier] = 0
+        while len(frontier):
+            starts = self.indptr[frontier]
+            cnts = self.indptr[frontier + 1] - starts
+            src = np.repeat(frontier, cnts)
+            idx = np.arange(np.sum(cnts)) + np.repeat(starts
+                                                      - np.cumsum(cnts)
+                                                      + cnts, cnts)
+            nbr = self.indices[idx]
+            new = np.isinf(dist[nbr])
+            nbr, first = np.unique(nbr[new], return_index=True)
+            src = src[new][first]
+            dist[nbr] = dist[src] + self.weights[idx[new][first]]
+            parent[nbr] = src
+            frontier = nbr
+        return dist, parent
+
+    def distanceAlongTree(self, nid):
+        '''DISTANCEALONGTREE - Distance along tree between nodes
+        As SBEMDB.DISTANCEALONGTREE.'''
+        rows = self.rows(np.atleast_1d(nid))
+        dist, parent = self.traverse(rows)
+        reached = np.nonzero(np.isfinite(dist))[0]
+        return dict(zip(self.nid[reached].tolist(), dist[reached].tolist()))
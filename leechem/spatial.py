@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+class GridIndex:
+    '''GRIDINDEX - Uniform grid hash for spatial queries on points
+
+    gi = GRIDINDEX(xyz) builds a spatial index over the given points,
+    which must be an Nx3 array. Points are binned into cubic cells, and
+    the cells are stored sorted by a linear cell key, so that the points
+    in any cell can be found by binary search.
+    Optional argument CELLSIZE specifies the size of the cells, in the
+    same units as XYZ. By default, it is chosen so that there are a few
+    points in a typical occupied cell.
+
+    Queries return indices into the original XYZ array.'''
+    def __init__(self, xyz, cellsize=None):
+        self.xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        N = len(self.xyz)
+        if N:
+            self.lo = np.min(self.xyz, 0)
+            ext = np.max(self.xyz, 0) - self.lo
+        else:
+            self.lo = np.zeros(3)
+            ext = np.zeros(3)
+        if cellsize is None:
+            vol = np.prod(np.maximum(ext, 1e-3))
+            cellsize = max((4 * vol / max(N, 1))**(1/3), 1e-3)
+        self.cellsize = cellsize
+        self.shape = (ext // cellsize).astype(int) + 1
+        keys = self._keys(self._cells(self.xyz))
+        self.order = np.argsort(keys, kind='stable')
+        self.cellkeys, self.cellstart = np.unique(keys[self.order],
+                                                  return_index=True)
+        self.cellend = np.append(self.cellstart[1:], N)
+
+    def _cells(self, xyz):
+        return np.floor((xyz - self.lo) / self.cellsize).astype(int)
+
+    def _keys(self, cells):
+        return (cells[...,0]
+                + self.shape[0] * (cells[...,1]
+                                   + self.shape[1] * cells[...,2]))
+
+    def _candidates(self, p, r):
+        # Indices of all points in cells that overlap the cube of
+        # half-width R around P
+        c0 = np.maximum(self._cells(p - r), 0)
+        c1 = np.minimum(self._cells(p + r), self.shape - 1)
+        if np.any(c1 < c0):
+            return np.zeros(0, dtype=int)
+        cc = np.stack(np.meshgrid(np.arange(c0[0], c1[0] + 1),
+                                  np.arange(c0[1], c1[1] + 1),
+                                  np.arange(c0[2], c1[2] + 1),
+                                  indexing='ij'), -1).reshape(-1, 3)
+        keys = self._keys(cc)
+        k = np.minimum(np.searchsorted(self.cellkeys, keys),
+                       len(self.cellkeys) - 1)
+        k = k[self.cellkeys[k] == keys]
+        if len(k)==0:
+            return np.zeros(0, dtype=int)
+        cnts = self.cellend[k] - self.cellstart[k]
+        idx = np.arange(np.sum(cnts)) + np.repeat(self.cellstart[k]
+                                                  - np.cumsum(cnts)
+                                                  + cnts, cnts)
+        return self.order[idx]
+
+    def within(self, p, r):
+        '''WITHIN - Points within a given distance
+        (ii, dd) = WITHIN(p, r) returns the indices of all points that lie
+        within distance R of the point P, sorted by distance, as well as
+        those distances.
+        P must be finite; otherwise, a ValueError is raised.'''
+        p = np.asarray(p, dtype=float)
+        if not np.all(np.isfinite(p)):
+            raise ValueError('Query point must be finite')
+        if len(self.cellkeys)==0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        ii = self._candidates(p, r)
+        dd = np.sqrt(np.sum((self.xyz[ii] - p)**2, 1))
+        keep = dd <= r
+        ii = ii[keep]
+        dd = dd[keep]
+        order = np.argsort(dd, kind='stable')
+        return ii[order], dd[order]
+
+    def nearest(self, p, k=1):
+        '''NEAREST - Nearest points
+        (ii, dd) = NEAREST(p, k) returns the indices of the K points
+        nearest to the point P, sorted by distance, as well as their
+        distances. Fewer than K points are returned only if the index
+        contains fewer than K points.
+        P must be finite; otherwise, a ValueError is raised.'''
+        p = np.asarray(p, dtype=float)
+        if not np.all(np.isfinite(p)):
+            raise ValueError('Query point must be finite')
+        k = min(k, len(self.xyz))
+        if k==0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        # Distance from P to the bounding box of all points
+        gap = np.maximum(np.maximum(self.lo - p,
+                                    p - (self.lo + self.shape*self.cellsize)),
+                         0)
+        r = np.sqrt(np.sum(gap**2)) + self.cellsize
+        while True:
+            ii = self._candidates(p, r)
+            if len(ii) >= k:
+                dd = np.sqrt(np.sum((self.xyz[ii] - p)**2, 1))
+                order = np.argsort(dd, kind='stable')[:k]
+                if dd[order[-1]] <= r:
+                    # All points within R are among the candidates, so
+                    # these are truly the nearest
+                    return ii[order], dd[order]
+            r *= 2
+
+    def withinMany(self, pp, r):
+        '''WITHINMANY - Points within a given distance of many points
+        res = WITHINMANY(pp, r), where PP is an Nx3 array, returns a list
+        of N (ii, dd) tuples, one for each point, as from WITHIN.'''
+        pp = np.asarray(pp, dtype=float).reshape(-1, 3)
+        if not np.all(np.isfinite(pp)):
+            raise ValueError('Query points must be finite')
+        return [ self.within(p, r) for p in pp ]
+
+    def nearestMany(self, pp, k=1):
+        '''NEARESTMANY - Nearest points to many points
+        (ii, dd) = NEARESTMANY(pp, k), where PP is an Nx3 array, returns
+        NxK arrays of indices and distances of the K nearest points to
+        each of the points in PP, as from NEAREST.'''
+        pp = np.asarray(pp, dtype=float).reshape(-1, 3)
+        if not np.all(np.isfinite(pp)):
+            raise ValueError('Query points must be finite')
+        k = min(k, len(self.xyz))
+        ii = np.zeros((len(pp), k), dtype=int)
+        dd = np.zeros((len(pp), k))
+        for n, p in enumerate(pp):
+            ii[n], dd[n] = self.nearest(p, k)
+        return ii, dd
@@ -2,6 +2,14 @@
 
 import numpy as np
 from . import sbemdb
+from . import bvh
+
+# The parts of a TREE that change when segments are dropped. Everything
+# else (nodes, edges, the original segments, and the BVH) is fixed once
+# the tree is built, and shared between copies.
+SEGARRAYS = ('kids', 'parents', 'depths', 'nedges', 'conts', 'tails',
+             'pathlens', 'hassyns', 'nbrdists', 'skeldists', 'skelncids',
+             'edgeseg')
 
 class Segment:
     '''SEGMENT - Representation of a segment of a tree
@@ -27,7 +35,8 @@ class Segment:
       the root of the tree has ID 0, and a child segment always has a higher
       numbered ID than its parent.)
     - PARENT - The ID of the parent of the segment, or None for the root
-    - CHILDREN - A list of the IDs of the children of this segment
+    - CHILDREN - A tuple of the IDs of the children of this segment
+    - NODES - A tuple of the IDs of the nodes of this segment
     - PATHLEN - The length of the segment, measured as the sum of the 
       lengths of the edges between its nodes
     - HASSYN - True or False depending on whether the segment contains
@@ -43,18 +52,89 @@ class Segment:
       tree that is not on this segment and (2) the "scid" of the edge that
       contains that point (see the "nodecons" table in the sbemdb).
       (SKELETON_DIST is only calculated for terminal segments.)
+
+    A SEGMENT does not hold any data itself: it is a view of one row of
+    the segment table of its TREE, and its properties read and write the
+    arrays of that table. CHILDREN and NODES are tuples, so they cannot
+    be modified in place: use TREE.DROP to remodel the tree. CHILDREN
+    may be assigned as a whole; NODES cannot be assigned at all.
     '''
-    def __init__(self, sid=None, parent=None, nodes=[]):
-        '''Construct an empty segment'''
+    __slots__ = ('tree', 'sid')
+    
+    def __init__(self, tree, sid):
+        '''Segment(tree, sid) constructs a view of segment SID of TREE'''
+        self.tree = tree
         self.sid = sid
-        self.parent = parent
-        self.nodes = nodes
-        self.children = []
-        self.pathlen = None
-        self.hassyn = None
-        self.depth = 0 # Number of junctions from root
-        self.neighbor_dist = None 
-        self.skeleton_dist = None
+
+    @property
+    def parent(self):
+        pid = self.tree.parents[self.sid]
+        return None if pid < 0 else int(pid)
+
+    @parent.setter
+    def parent(self, pid):
+        self.tree._w('parents')[self.sid] = -1 if pid is None else pid
+
+    @property
+    def children(self):
+        return self.tree.kids[self.sid]
+
+    @children.setter
+    def children(self, sids):
+        self.tree._w('kids')[self.sid] = tuple(sids)
+
+    @property
+    def nodes(self):
+        return tuple(self.tree.nids[self.tree._nodeidx(self.sid)].tolist())
+
+    @property
+    def pathlen(self):
+        return float(self.tree.pathlens[self.sid])
+
+    @pathlen.setter
+    def pathlen(self, x):
+        self.tree._w('pathlens')[self.sid] = x
+
+    @property
+    def hassyn(self):
+        return bool(self.tree.hassyns[self.sid])
+
+    @hassyn.setter
+    def hassyn(self, x):
+        self.tree._w('hassyns')[self.sid] = x
+
+    @property
+    def depth(self):
+        return int(self.tree.depths[self.sid])
+
+    @depth.setter
+    def depth(self, x):
+        self.tree._w('depths')[self.sid] = x
+
+    @property
+    def neighbor_dist(self):
+        d = self.tree.nbrdists[self.sid]
+        return None if np.isnan(d) else float(d)
+
+    @neighbor_dist.setter
+    def neighbor_dist(self, d):
+        self.tree._w('nbrdists')[self.sid] = np.nan if d is None else d
+
+    @property
+    def skeleton_dist(self):
+        d = self.tree.skeldists[self.sid]
+        if np.isnan(d):
+            return None
+        return (float(d), int(self.tree.skelncids[self.sid]))
+
+    @skeleton_dist.setter
+    def skeleton_dist(self, dn):
+        if dn is None:
+            self.tree._w('skeldists')[self.sid] = np.nan
+            self.tree._w('skelncids')[self.sid] = -1
+        else:
+            self.tree._w('skeldists')[self.sid] = dn[0]
+            self.tree._w('skelncids')[self.sid] = dn[1]
         
     def is_terminal(self):
         '''IS_TERMINAL - Returns true if the segment has no children'''
@@ -62,20 +142,17 @@ class Segment:
 
     def edge_count(self):
         '''EDGE_COUNT() returns the number of EDGES in the chain'''
-        N = len(self.nodes)
-        if N==0:
-            return 0
-        else:
-            return N-1
+        return int(self.tree.nedges[self.sid])
     
     def __repr__(self):
+        nodes = self.nodes
         r = f'Segment({self.sid})'
-        if len(self.nodes)==1:
-            r += f' with 1 node: [{self.nodes[0]}]'
+        if len(nodes)==1:
+            r += f' with 1 node: [{nodes[0]}]'
         else:
-            r += f' with {len(self.nodes)} nodes'
-            if len(self.nodes)>=2:
-                r += f': [{self.nodes[0]} ... {self.nodes[-1]}]'
+            r += f' with {len(nodes)} nodes'
+            if len(nodes)>=2:
+                r += f': [{nodes[0]} ... {nodes[-1]}]'
         if len(self.children)==1:
             r += f' and 1 child'
         elif len(self.children)==0:
@@ -91,226 +168,357 @@ class Tree(dict):
     The root of the tree has ID zero. 
 
     - DROP: Remove a terminal segment from the tree and remodel as needed.
+    - TABLE: The segments as a record array.
+    - COPY: A copy-on-write copy of the tree.
+
+    The nodes and edges of the tree are loaded from the database once:
+    - NIDS, TYPS, XYZ - Node IDs (in order), types, and coordinates (in
+      microns) of all nodes. Nodes are referred to by "local index", i.e.,
+      position in NIDS.
+    - NCIDS, EDGES - Connection IDs and Kx2 array of local indices of the
+      end points of all edges.
+
+    The segments themselves are stored in a table of flat arrays indexed
+    by segment ID; the SEGMENT objects in the dict are views into it:
+    - FLAT, OFFSETS - The local indices of the nodes of each segment as
+      originally found are FLAT[OFFSETS[sid]:OFFSETS[sid+1]].
+    - CONTS, TAILS - When DROP merges a segment with its only remaining
+      sibling, the sibling's nodes are appended by linking the sibling as
+      the continuation (CONTS) of the last segment (TAILS) in the chain of
+      the parent. CONTS is -1 at the end of a chain.
+    - PARENTS (-1 for the root), KIDS (tuples of children), DEPTHS,
+      NEDGES, PATHLENS, HASSYNS, NBRDISTS (NaN where undefined),
+      SKELDISTS (NaN where undefined) and SKELNCIDS.
+    - EDGESEG - The segment that contains each edge, or -1 for edges that
+      are not (or no longer) part of any segment.
+    - DROPPED - The IDs of the segments removed by DROP, in order.
 '''
     
     def __init__(self, rootnid, db):
         '''Tree(rootnid, db) construct a tree starting from the given node.
         DB must be an SBEMDB'''
-        self.seen = set()
-        tid = db.fetch(f'select tid from nodes where nid=={rootnid}')[0][0]
+        tid = db.treeof(rootnid)
         self.tid = tid
         self.rootnid = rootnid
-        rows = db.fetch(f'''select nid1, nid2 from nodecons 
-        inner join nodes on nid2==nid
-        where tid=={tid}''')
-        self.cons = {}
-        for row in rows:
-            if row[0] not in self.cons:
-                self.cons[row[0]] = []
-            self.cons[row[0]].append(row[1])
-        self._explore([rootnid], None)
-        del self.cons
-        del self.seen
-        self._typify(db, tid)
-        self._establish_depths()
-        self._establish_lengths(db, rootnid)
+        self._load(db)
+        self._explore(int(self._local(rootnid)))
         self._establish_neighbor_dists(db)
         self._establish_skeleton_dists(db)
 
-    def _idgen(self):
-        return len(self)
-
-    def _explore(self, chain, parent):
-        nid = chain[-1]
-        for n in chain:
-            self.seen.add(n)
-        while True:
-            nids = [n for n in self.cons[nid] if n not in self.seen]
-            for n in nids:
-                self.seen.add(n)
-            if len(nids)==0:
-               myid = self._idgen()
-               s = Segment(myid, parent, chain)
-               self[myid] = s
-               return myid
-            elif len(nids)==1:
-                chain.append(nids[0])
-                nid = nids[0]
-            else:
-               myid = self._idgen()
-               s = Segment(myid, parent, chain)
-               self[myid] = s
-               for n in nids:
-                   self[myid].children.append(self._explore([nid, n], myid))
-               return myid
-
-    def _establish_depths(self):
-        sids = list(self.keys())
-        sids.sort()
-        for sid in sids:
-            pid = self[sid].parent
-            if pid is None:
-                self[sid].depth = 0
-            else:
-                par = self[pid]
-                self[sid].depth = self[pid].depth + 1
+    def _load(self, db):
+        nodes = db.treenodes(self.tid)
+        cons = db.treecons(self.tid)
+        self.nids = np.asarray(nodes.nid)
+        self.typs = np.asarray(nodes.typ)
+        self.xyz = np.stack((nodes.x, nodes.y, nodes.z), 1)
+        self.ncids = np.asarray(cons.ncid)
+        self.edges = np.stack((self._local(cons.nid1),
+                               self._local(cons.nid2)), 1).reshape(-1, 2)
 
-    def _establish_lengths(self, db, rootnid):
-        dd = db.distanceAlongTree(rootnid)
-        for sid, seg in self.items():
-            self[sid].pathlen = dd[seg.nodes[-1]] - dd[seg.nodes[0]]
-                   
-    def _typify(self, db, tid):
-        rows = db.fetch(f'select nid, typ from nodes where tid=={tid}')
-        typs = { row[0]: row[1] for row in rows }
-        for sid, seg in self.items():
-            hassyn = False
-            for n in seg.nodes:
-                if typs[n]==6:
-                    hassyn = True
+    def _local(self, nids):
+        nids = np.asarray(nids, dtype=int)
+        ii = np.minimum(np.searchsorted(self.nids, nids),
+                        max(len(self.nids) - 1, 0))
+        if len(self.nids)==0 or np.any(self.nids[ii] != nids):
+            raise KeyError(f'Node not on tree {self.tid}')
+        return ii
+
+    def _explore(self, root):
+        # Build the segment table by depth-first traversal from the local
+        # index ROOT, using an explicit stack of (chain, parent) pairs
+        # rather than recursion. Segments are numbered in the order they
+        # are completed, which (because each branch is fully explored
+        # before the next) is a pre-order numbering.
+        V = len(self.nids)
+        a = self.edges[:,0]
+        b = self.edges[:,1]
+        src = np.stack((a, b), 1).ravel()
+        dst = np.stack((b, a), 1).ravel()
+        order = np.argsort(src, kind='stable')
+        nbrs = dst[order].tolist()
+        indptr = np.zeros(V + 1, dtype=int)
+        np.cumsum(np.bincount(src, minlength=V), out=indptr[1:])
+        indptr = indptr.tolist()
+
+        seen = [False] * V
+        flat = []
+        offsets = [0]
+        parents = []
+        depths = []
+        kids = []
+        stack = [([root], -1)]
+        while stack:
+            chain, parent = stack.pop()
+            for n in chain:
+                seen[n] = True
+            nid = chain[-1]
+            while True:
+                nxt = [n for n in nbrs[indptr[nid]:indptr[nid+1]]
+                       if not seen[n]]
+                for n in nxt:
+                    seen[n] = True
+                if len(nxt)!=1:
                     break
-            self[sid].hassyn = hassyn
+                chain.append(nxt[0])
+                nid = nxt[0]
+            myid = len(parents)
+            flat += chain
+            offsets.append(len(flat))
+            parents.append(parent)
+            kids.append([])
+            if parent < 0:
+                depths.append(0)
+            else:
+                depths.append(depths[parent] + 1)
+                kids[parent].append(myid)
+            for n in nxt[-1::-1]:
+                stack.append(([nid, n], myid))
+
+        S = len(parents)
+        self.flat = np.array(flat, dtype=int)
+        self.offsets = np.array(offsets)
+        self.parents = np.array(parents)
+        self.kids = [ tuple(k) for k in kids ]
+        self.depths = np.array(depths)
+        self.nedges = np.diff(self.offsets) - 1
+        self.conts = np.full(S, -1)
+        self.tails = np.arange(S)
+        self.nbrdists = np.full(S, np.nan)
+        self.skeldists = np.full(S, np.nan)
+        self.skelncids = np.full(S, -1)
+        self.dropped = []
+        self.shared = set()
+
+        # Steps between consecutive entries of FLAT, and the segments that
+        # contain them (-1 where a step crosses into the next segment)
+        segof = np.repeat(np.arange(S), np.diff(self.offsets))
+        stepseg = np.where(segof[1:]==segof[:-1], segof[:-1], -1)
+        steps = np.sqrt(np.sum((self.xyz[self.flat[1:]]
+                                - self.xyz[self.flat[:-1]])**2, 1))
+        inner = stepseg >= 0
+        self.pathlens = np.bincount(stepseg[inner], steps[inner], minlength=S)
+        self.hassyns = np.bincount(segof, self.typs[self.flat]==6,
+                                   minlength=S) > 0
+
+        # Map steps to edges
+        edgeidx = { (min(n1, n2), max(n1, n2)): k
+                    for k, (n1, n2) in enumerate(self.edges.tolist()) }
+        n1 = np.minimum(self.flat[1:], self.flat[:-1]).tolist()
+        n2 = np.maximum(self.flat[1:], self.flat[:-1]).tolist()
+        self.stepedge = np.array([ edgeidx.get((p, q), -1) if s >= 0 else -1
+                                   for p, q, s in zip(n1, n2,
+                                                      stepseg.tolist()) ],
+                                 dtype=int)
+        self.edgeseg = np.full(len(self.edges), -1)
+        use = self.stepedge >= 0
+        self.edgeseg[self.stepedge[use]] = stepseg[use]
+
+        for sid in range(S):
+            self[sid] = Segment(self, sid)
+
+    def _w(self, name):
+        # The array NAME (one of SEGARRAYS), ready for writing: if it is
+        # shared with a copy of the tree, it is copied first.
+        if name in self.shared:
+            setattr(self, name, getattr(self, name).copy())
+            self.shared.remove(name)
+        return getattr(self, name)
+
+    def copy(self):
+        '''COPY - Copy-on-write copy of the tree
+        tree2 = COPY() returns a new TREE with the same segments. The two
+        trees share all their arrays until one of them modifies one (by
+        DROP or by assigning to a segment property), at which point that
+        tree gets its own copy of that array. The arrays that describe the
+        nodes and edges themselves are never modified, and remain shared.'''
+        tree = Tree.__new__(Tree)
+        tree.__dict__.update(self.__dict__)
+        self.shared = set(SEGARRAYS)
+        tree.shared = set(SEGARRAYS)
+        tree.dropped = list(self.dropped)
+        for sid in self.keys():
+            tree[sid] = Segment(tree, sid)
+        return tree
+
+    def _chain(self, sid):
+        # The segments (as originally found) that make up segment SID
+        while sid >= 0:
+            yield sid
+            sid = self.conts[sid]
+
+    def _nodeidx(self, sid):
+        # Local indices of the nodes of segment SID
+        parts = []
+        for s in self._chain(sid):
+            k0 = self.offsets[s]
+            if parts:
+                k0 += 1
+            parts.append(self.flat[k0:self.offsets[s+1]])
+        return np.concatenate(parts)
+
+    def _edgeidx(self, sid):
+        # Indices into EDGES of the edges of segment SID
+        ee = np.concatenate([ self.stepedge[self.offsets[s]:
+                                            self.offsets[s+1] - 1]
+                              for s in self._chain(sid) ])
+        return ee[ee >= 0]
+
+    def _first(self, sid):
+        return self.flat[self.offsets[sid]]
+
+    def _last(self, sid):
+        return self.flat[self.offsets[self.tails[sid] + 1] - 1]
+
+    def _penultimate(self, sid):
+        # Local index of the next-to-last node of segment SID, or None
+        # if the segment has only one node
+        t = self.tails[sid]
+        if self.offsets[t+1] - self.offsets[t] < 2:
+            return None
+        return self.flat[self.offsets[t+1] - 2]
 
     def is_terminal(self, sid):
         '''IS_TERMINAL(id) returns true if the segment has no children'''
-        return len(self[sid].children)==0
+        return len(self.kids[sid])==0
 
     def siblings(self, sid):
         '''SIBLINGS(sid) returns a list of siblings of a given segment.'''
-        pid = self[sid].parent
-        if pid is None:
+        pid = self.parents[sid]
+        if pid < 0:
             return []
-        return [ s for s in self[pid].children if s != sid ]
+        return [ s for s in self.kids[pid] if s != sid ]
             
     def drop(self, sid):
         '''DROP(id) removes the named segment from the tree.
         Only terminal segments can be removed.
         The tree is remodeled such that if the removed segment had 
         precisely one sibling, that sibling is concatenated to its 
-        parent and removed from the tree.'''
+        parent and removed from the tree.
+        NEIGHBOR_DIST and SKELETON_DIST are updated for the segments that
+        are affected: the remaining siblings, or the parent if it absorbed
+        the last sibling. (The edges of the removed segment still count as
+        part of the tree for the SKELETON_DIST of others.)'''
         if not self.is_terminal(sid):
             raise ValueError(f'Cannot drop internal segment {sid}')
-        pid = self[sid].parent
+        pid = self.parents[sid]
+        if pid < 0:
+            raise ValueError(f'Cannot drop root segment {sid}')
         sibs = self.siblings(sid)
-        self[pid].children.remove(sid)
+        self._w('kids')[pid] = tuple(sibs)
+        self._w('edgeseg')[self._edgeidx(sid)] = -1
         del self[sid]
-
-        def reestablish_depth(tree, sid, d):
-            for s in tree[sid].children:
-                tree[s].depth = d + 1
-                reestablish_depth(tree, s, d + 1)
+        self.dropped.append(sid)
 
         if len(sibs)==1:
             sib = sibs[0]
-            self[pid].nodes += self[sib].nodes[1:]
-            if self[sib].hassyn:
-                self[pid].hassyn = True
-            self[pid].children = self[sib].children
-            self[pid].pathlen += self[sib].pathlen
-            for c in self[pid].children:
-                self[c].parent = pid
+            self._w('edgeseg')[self._edgeidx(sib)] = pid
+            self._w('conts')[self.tails[pid]] = sib
+            self._w('tails')[pid] = self.tails[sib]
+            if self.hassyns[sib]:
+                self._w('hassyns')[pid] = True
+            self._w('kids')[pid] = self.kids[sib]
+            self._w('pathlens')[pid] += self.pathlens[sib]
+            self._w('nedges')[pid] += self.nedges[sib]
+            for c in self.kids[pid]:
+                self._w('parents')[c] = pid
             del self[sib]
-            reestablish_depth(self, pid, self[pid].depth)
-
-    def _all_edges(self, db, tid=None):
-        '''_ALL_EDGES - Return all the edges in a tree. They are returned
-        as a dict from nodecon ID to a pair of node IDs.'''
-        if tid is None:
-            tid = self.tid
-        rows = db.fetch(f'''select ncid, nid1, nid2 from nodecons 
-        left join nodes on nodecons.nid1==nodes.nid
-        where tid=={tid} and nid1<nid2''')
-        edges = {}
-        for row in rows:
-            edges[row[0]] = ( row[1], row[2] )
-        return edges
-
-    def _all_points(self, db, tid=None):
-        if tid is None:
-            tid = self.tid
-        (xx, yy, zz, nids) = db.nodexyz(f'tid=={tid}')
-        K = len(xx)
-        nodes = {}
-        for k in range(K):
-            nodes[nids[k]] = ( xx[k], yy[k], zz[k] )
-        return nodes
-
-    def _skeleton_dist(self, sid, db, edg=None, pts=None):
-        if edg is None:
-            edg = self._all_edges(db)
-        if pts is None:
-            pts = self._all_points(db)
-        ncid0 = None
-        dist0 = 1e20
-        nn = self[sid].nodes
-        nid_term = nn[-1]
-        p = pts[nid_term]
-        for ncid, nids in edg.items():
-            n1, n2 = nids
-            if n1 not in nn or n2 not in nn:
-                # This edge is not part of the named segment
-                p1 = pts[n1]
-                p2 = pts[n2]
-                d1 = sbemdb.LineSegmentGeom.pointDistance(p, p1, p2)
-                if d1<dist0:
-                    dist0 = d1
-                    ncid0 = ncid
-        return (dist0, ncid0)
+            stack = [pid]
+            while stack:
+                s = stack.pop()
+                for c in self.kids[s]:
+                    self._w('depths')[c] = self.depths[s] + 1
+                    stack.append(c)
+            self[pid].neighbor_dist = self._neighbor_dist(pid)
+            if self.is_terminal(pid):
+                self[pid].skeleton_dist = self._skeleton_dist(pid)
+        else:
+            for s in sibs:
+                self[s].neighbor_dist = self._neighbor_dist(s)
+
+    def table(self):
+        '''TABLE - The segments as a record array
+        rec = TABLE() returns a record array with one row per segment, in
+        order of segment ID, with fields SID, PARENT (-1 for the root),
+        DEPTH, NCHILDREN, NEDGES, PATHLEN, HASSYN, FIRSTNID, LASTNID,
+        NEIGHBOR_DIST and SKELETON_DIST (NaN where undefined), and
+        SKELETON_NCID (-1 where undefined).'''
+        sids = np.array(sorted(self.keys()), dtype=int)
+        first = self.flat[self.offsets[sids]]
+        last = self.flat[self.offsets[self.tails[sids] + 1] - 1]
+        return np.rec.fromarrays((sids, self.parents[sids], self.depths[sids],
+                                  np.array([ len(self.kids[s]) for s in sids ],
+                                           dtype=int),
+                                  self.nedges[sids], self.pathlens[sids],
+                                  self.hassyns[sids],
+                                  self.nids[first], self.nids[last],
+                                  self.nbrdists[sids], self.skeldists[sids],
+                                  self.skelncids[sids]),
+                                 names='sid,parent,depth,nchildren,nedges,'
+                                 + 'pathlen,hassyn,firstnid,lastnid,'
+                                 + 'neighbor_dist,skeleton_dist,skeleton_ncid')
+
+    def _skeleton_index(self, db=None):
+        '''_SKELETON_INDEX - Return a SEGMENTBVH over all the edges in the
+        tree. The geometry is only built once, and is shared between
+        copies of the tree, so the BVH does not hold labels of its own:
+        queries must pass EDGESEG, which labels each edge by the ID of
+        the segment that contains it, and which DROP keeps up to date.'''
+        if getattr(self, 'bvh', None) is None:
+            self.bvh = bvh.SegmentBVH(self.xyz[self.edges[:,0]],
+                                      self.xyz[self.edges[:,1]],
+                                      ids=self.ncids)
+        return self.bvh
+
+    def _skeleton_dist(self, sid, db=None):
+        '''_SKELETON_DIST - Distance between the terminal node of the given
+        segment and the nearest edge of the tree not on that segment.
+        Returns a (distance, ncid) tuple.'''
+        idx = self._skeleton_index(db)
+        return idx.nearest(self.xyz[self._last(sid)], sid, self.edgeseg)
     
-    def _establish_skeleton_dists(self, db):
+    def _establish_skeleton_dists(self, db=None):
         '''The skeleton distance is the shortest distance between the
         terminal node of a segment and any other point in the tree.'''
-        edg = self._all_edges(db)
-        pts = self._all_points(db)
+        idx = self._skeleton_index(db)
         print('Establishing skeleton distances...')
-        for s in self.keys():
-            if self[s].is_terminal():
-                self[s].skeleton_dist = self._skeleton_dist(s, db, edg, pts)
-                print(s, end='\r')
-            else:
-                self[s].skeleton_dist = None
+        terms = [ s for s in self.keys() if self.is_terminal(s) ]
+        self._w('skeldists')[:] = np.nan
+        self._w('skelncids')[:] = -1
+        dists, ncids = idx.nearestMany(self.xyz[[ self._last(s)
+                                                  for s in terms ]], terms,
+                                       self.edgeseg)
+        self._w('skeldists')[terms] = dists
+        self._w('skelncids')[terms] = ncids
         print()
             
-    def _neighbor_dist(self, sid, db, pts=None):
+    def _neighbor_dist(self, sid, db=None):
         '''NEIGHBOR_DIST - Distance between terminal node and neighboring edges
-        NEIGHBOR_DIST(seg_id, db) returns the distance (in microns) between
+        NEIGHBOR_DIST(seg_id) returns the distance (in microns) between
         the terminal node of the given chain and the edges in the chain's
         parent or siblings that are adjacent to the given chains base
-        node. Second argument must be a SBEMDB to use for measurements.'''
-        nid_term = self[sid].nodes[-1]
-        nid_base = self[sid].nodes[0]
-        if pts is not None:
-            p = pts[nid_term]
-            p1 = pts[nid_base]
-        par_id = self[sid].parent
-        if par_id is None:
+        node.'''
+        par_id = self.parents[sid]
+        if par_id < 0:
             return None
-        sib_ids = self.siblings(sid)
-        nid_neighbors = [ self[par_id].nodes[-2] ]
-        for s in sib_ids:
-            nid_neighbors.append(self[s].nodes[1])
-            if pts is None:
-                dd = [ db.nodeToEdgeDistance(nid_term, nid_base, n_nei)
-                       for n_nei in nid_neighbors ]
-            else:
-                dd = [ sbemdb.LineSegmentGeom.pointDistance(p, p1, pts[n_nei])
-                       for n_nei in nid_neighbors ]
-                
+        neighbors = [ self.flat[self.offsets[s] + 1]
+                      for s in self.siblings(sid) ]
+        pen = self._penultimate(par_id)
+        if pen is not None:
+            neighbors.insert(0, pen)
+        if len(neighbors)==0:
+            return None
+        dd = sbemdb.LineSegmentGeom.pointDistances(
+            self.xyz[self._last(sid)], self.xyz[self._first(sid)],
+            self.xyz[neighbors])
         return np.min(dd)
 
-    def _establish_neighbor_dists(self, db):
-        pts = self._all_points(db)
+    def _establish_neighbor_dists(self, db=None):
         print('Establishing neighbor distances...')
         for s in self.keys():
-            self[s].neighbor_dist = self._neighbor_dist(s, db, pts)
+            self[s].neighbor_dist = self._neighbor_dist(s)
 
-    def prune_stubs(self, db, max_dist_um, max_edge_cnt=1, use_skel=True):
-        '''PRUNE_STUBS - Remove very short terminal segments and remodel
-        PRUNE_STUBS(db, max_dist_um) prunes terminal segments that have
-        SKELETON_DIST less than MAX_DIST_UM and EDGE_COUNT equal to one.
-        Optional argument MAX_EDGE_CNT overrides the latter threshold.
-        Optional argument USE_SKEL can be set to FALSE to use NEIGHBOR_DIST
-        instead of SKELETON_DIST.'''
+    def _prune_order(self, max_dist_um, max_edge_cnt, use_skel):
+        # The segments that PRUNE_STUBS would try to drop, in order
         cands = set()
         if use_skel:
             def is_short(seg):
@@ -338,30 +546,65 @@ class Tree(dict):
                 sibs.append(sid)
                 lens = [ self[s].pathlen for s in sibs ]
                 keep.add(sibs[np.argmax(lens)])
-        for s in keep:
-            cands.remove(s)
-            cands = list(cands)
-            cands.sort()
-        for s in cands[-1::-1]:
+        cands = list(cands - keep)
+        cands.sort()
+        return cands[-1::-1]
+
+    def prune_stubs(self, db, max_dist_um, max_edge_cnt=1, use_skel=True):
+        '''PRUNE_STUBS - Remove very short terminal segments and remodel
+        PRUNE_STUBS(db, max_dist_um) prunes terminal segments that have
+        SKELETON_DIST less than MAX_DIST_UM and EDGE_COUNT equal to one.
+        Optional argument MAX_EDGE_CNT overrides the latter threshold.
+        Optional argument USE_SKEL can be set to FALSE to use NEIGHBOR_DIST
+        instead of SKELETON_DIST.
+        Candidates are selected once, from the distances before pruning.
+        Since DROP maintains the distances of the segments it affects,
+        they are current afterwards without being recomputed for the
+        whole tree.'''
+        for s in self._prune_order(max_dist_um, max_edge_cnt, use_skel):
             if s in self:
                 self.drop(s)
-                if not use_skel:
-                    self._establish_neighbor_dists(db)
-        self._establish_neighbor_dists(db)
-        self._establish_skeleton_dists(db)
+
+    def prune_sweep(self, db, thresholds, max_edge_cnt=1, use_skel=True):
+        '''PRUNE_SWEEP - Prune at many thresholds
+        res = PRUNE_SWEEP(db, thresholds) returns a dict mapping each of the
+        given values of MAX_DIST_UM to a copy of this tree pruned with
+        PRUNE_STUBS(db, max_dist_um). Values in THRESHOLDS may also be
+        (max_dist_um, max_edge_cnt) tuples. Optional arguments MAX_EDGE_CNT
+        and USE_SKEL are as for PRUNE_STUBS. The tree itself is not
+        modified.
+        The results are identical to building a fresh tree for each
+        threshold and pruning it, but the tree is built only once, and the
+        copies are copy-on-write (see COPY), so that they share everything
+        that pruning does not change. Thresholds are processed in
+        increasing order; thresholds that select the same segments for
+        removal as the next lower one share their result. Each copy lists
+        the segments it dropped, in order, in DROPPED. Use TABLE to obtain
+        the pruned segment tables.'''
+        self._skeleton_index(db) # so that all copies share it
+        def setting(thr):
+            if np.isscalar(thr):
+                return (thr, max_edge_cnt)
+            return tuple(thr)
+        res = {}
+        prev = None
+        for thr in sorted(thresholds, key=setting):
+            order = self._prune_order(*setting(thr), use_skel)
+            if prev is not None and order==prev[0]:
+                res[thr] = prev[1].copy()
+                continue
+            tree = self.copy()
+            for s in order:
+                if s in tree:
+                    tree.drop(s)
+            res[thr] = tree
+            prev = (order, tree)
+        return { thr: res[thr] for thr in thresholds }
 
     def plot(self, db):
         import matplotlib.pyplot as plt
         def xyz(nodes):
-            xx=[]
-            yy=[]
-            zz=[]
-            for n in nodes:
-                x,y,z = db.onenodexyz(n)
-                xx.append(x)
-                yy.append(y)
-                zz.append(z)
-            return xx,yy,zz
+            return db.nodexyzMany(nodes)
         plt.figure()
         for sid, seg in self.items():
             xx,yy,zz = xyz(seg.nodes)
@@ -389,7 +632,10 @@ class Tree(dict):
                     typ = 'ts'
                 else:
                     typ = 'is'
-                for k in range(1, len(seg.nodes)):
-                    fd.write(f'{sid},0,{typ},{seg.depth},{seg.hassyn},'
-                             + f'{seg.nodes[k]},{seg.nodes[k-1]}\n')
+                nodes = seg.nodes
+                depth = seg.depth
+                hassyn = seg.hassyn
+                for k in range(1, len(nodes)):
+                    fd.write(f'{sid},0,{typ},{depth},{hassyn},'
+                             + f'{nodes[k]},{nodes[k-1]}\n')
                     
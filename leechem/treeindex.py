@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+class TreeIndex:
+    '''TREEINDEX - Index for fast path-distance queries within a tree
+
+    idx = TREEINDEX(db, tid) builds an index over the given tree from
+    the given SBEMDB. The tree is rooted at its soma (or at its lowest
+    numbered node if it has no soma), and for each node the index stores:
+
+    - PARENT - The local index of the parent node, or -1 for the root
+    - DEPTH - The number of edges between the node and the root
+    - DIST - The length of the path along the tree between the node
+      and the root, in microns
+    - COMP - The connected component the node belongs to. (Normally, all
+      nodes of a tree are connected, but if they are not, each further
+      component gets its own root, and paths between components do not
+      exist.)
+
+    Lowest common ancestors are found in constant time using an Euler
+    tour of the tree and a sparse table of minimum depths, so that path
+    distances between arbitrary pairs of nodes can be computed without
+    traversing the tree.
+
+    All arrays are indexed by "local index", i.e., position in the NIDS
+    array, which lists the nodes of the tree in order of node ID. Use
+    LOCAL to convert node IDs to local indices.
+    '''
+    def __init__(self, db, tid, rootnid=None):
+        '''TreeIndex(db, tid) constructs an index for the given tree.
+        Optional argument ROOTNID overrides the choice of root node.'''
+        nodes = db.treenodes(tid)
+        cons = db.treecons(tid)
+        self.tid = tid
+        self.nids = np.asarray(nodes.nid)
+        self.typ = np.asarray(nodes.typ)
+        self.xyz = np.stack((nodes.x, nodes.y, nodes.z), 1)
+        V = len(self.nids)
+        if V==0:
+            raise KeyError(f'Tree {tid} not found')
+        if rootnid is None:
+            somas = np.nonzero(self.typ==1)[0]
+            root = somas[0] if len(somas) else 0
+        else:
+            root = self.local(rootnid)
+        self.rootnid = self.nids[root]
+
+        # Adjacency in compressed sparse row format
+        a = self.local(cons.nid1)
+        b = self.local(cons.nid2)
+        src = np.concatenate((a, b))
+        dst = np.concatenate((b, a))
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+        dst = dst[order]
+        indices = dst.tolist()
+        weights = np.sqrt(np.sum((self.xyz[src] - self.xyz[dst])**2,
+                                 1)).tolist()
+        indptr = np.zeros(V + 1, dtype=int)
+        np.cumsum(np.bincount(src, minlength=V), out=indptr[1:])
+        indptr = indptr.tolist()
+
+        # Depth-first traversal, recording the Euler tour
+        parent = [-1] * V
+        depth = [0] * V
+        dist = [0.0] * V
+        comp = [-1] * V
+        first = [0] * V
+        euler = []
+        roots = [root] + [n for n in range(V) if n != root]
+        ncomp = 0
+        for r in roots:
+            if comp[r] >= 0:
+                continue
+            comp[r] = ncomp
+            stack = [(r, indptr[r])]
+            first[r] = len(euler)
+            euler.append(r)
+            while stack:
+                node, k = stack[-1]
+                if k < indptr[node+1]:
+                    stack[-1] = (node, k + 1)
+                    nxt = indices[k]
+                    if comp[nxt] < 0:
+                        comp[nxt] = ncomp
+                        parent[nxt] = node
+                        depth[nxt] = depth[node] + 1
+                        dist[nxt] = dist[node] + weights[k]
+                        first[nxt] = len(euler)
+                        euler.append(nxt)
+                        stack.append((nxt, indptr[nxt]))
+                else:
+                    stack.pop()
+                    if stack:
+                        euler.append(stack[-1][0])
+            ncomp += 1
+        self.parent = np.array(parent)
+        self.depth = np.array(depth)
+        self.dist = np.array(dist)
+        self.comp = np.array(comp)
+        self.first = np.array(first)
+        self.euler = np.array(euler)
+
+        # Sparse table: SPARSE[j][i] is the node with minimum depth among
+        # EULER[i : i + 2**j]
+        self.sparse = [self.euler]
+        j = 1
+        while (1 << j) <= len(self.euler):
+            prev = self.sparse[-1]
+            h = 1 << (j - 1)
+            left = prev[:-h]
+            right = prev[h:]
+            better = self.depth[left] <= self.depth[right]
+            self.sparse.append(np.where(better, left, right))
+            j += 1
+
+    def local(self, nids):
+        '''LOCAL - Convert node IDs to local indices
+        ii = LOCAL(nids) returns the local indices of the given nodes.
+        NIDS may be a single node ID or an array. Raises KeyError if any
+        of the nodes are not on this tree.'''
+        nids = np.asarray(nids, dtype=int)
+        ii = np.minimum(np.searchsorted(self.nids, nids), len(self.nids) - 1)
+        bad = self.nids[ii] != nids
+        if np.any(bad):
+            raise KeyError(f'Node {nids[bad].flat[0]} not on tree {self.tid}')
+        return ii
+
+    def lca(self, ii, jj):
+        '''LCA - Lowest common ancestor
+        kk = LCA(ii, jj) returns the local indices of the lowest common
+        ancestors of the pairs of nodes with the given local indices.
+        II and JJ must be broadcastable to the same shape. The result is
+        meaningless for pairs that are not in the same component.'''
+        lo = np.minimum(self.first[ii], self.first[jj])
+        hi = np.maximum(self.first[ii], self.first[jj])
+        lev = np.log2(hi - lo + 1).astype(int)
+        left = np.empty(lo.shape, dtype=int)
+        right = np.empty(lo.shape, dtype=int)
+        for j in np.unique(lev):
+            use = lev==j
+            left[use] = self.sparse[j][lo[use]]
+            right[use] = self.sparse[j][hi[use] - (1 << j) + 1]
+        return np.where(self.depth[left] <= self.depth[right], left, right)
+
+    def localDistances(self, ii, jj):
+        '''LOCALDISTANCES - Distances between nodes given by local index
+        dd = LOCALDISTANCES(ii, jj) returns the distances (in microns) along
+        the tree between the nodes with local indices II and JJ, which must
+        be broadcastable to the same shape. Distances between nodes that
+        are not connected are infinite.'''
+        ii, jj = np.broadcast_arrays(ii, jj)
+        kk = self.lca(ii, jj)
+        dd = self.dist[ii] + self.dist[jj] - 2*self.dist[kk]
+        return np.where(self.comp[ii]==self.comp[jj], dd, np.inf)
+
+    def pathDistance(self, nid1, nid2):
+        '''PATHDISTANCE - Distance along the tree between two nodes
+        d = PATHDISTANCE(nid1, nid2) returns the length (in microns) of
+        the path along the tree between the given nodes, or infinity if
+        they are not connected.'''
+        return float(self.localDistances(self.local(nid1), self.local(nid2)))
+
+    def pathDistances(self, nids1, nids2):
+        '''PATHDISTANCES - Matrix of distances along the tree
+        dd = PATHDISTANCES(nids1, nids2) returns a matrix of the lengths
+        (in microns) of the paths along the tree between each of the nodes
+        in NIDS1 and each of the nodes in NIDS2.'''
+        ii = self.local(np.atleast_1d(nids1))
+        jj = self.local(np.atleast_1d(nids2))
+        return self.localDistances(ii[:,None], jj[None,:])
+
+    def distancesFrom(self, nid):
+        '''DISTANCESFROM - Distance from one node to all others
+        dd = DISTANCESFROM(nid) returns the distances (in microns) along
+        the tree from the given node to every node in the tree, in the
+        order of NIDS.'''
+        return self.localDistances(self.local(nid), np.arange(len(self.nids)))
+
+    def path(self, nid1, nid2):
+        '''PATH - Sequence of nodes between given nodes
+        nids = PATH(nid1, nid2) returns a list of all the nodes on the
+        path between the given end nodes, including those end nodes.'''
+        i = int(self.local(nid1))
+        j = int(self.local(nid2))
+        if self.comp[i] != self.comp[j]:
+            raise Exception('No path!?')
+        k = int(self.lca(i, j))
+        up = [i]
+        while up[-1] != k:
+            up.append(self.parent[up[-1]])
+        down = [j]
+        while down[-1] != k:
+            down.append(self.parent[down[-1]])
+        return self.nids[up + down[-2::-1]].tolist()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from leechem import sbemdb
+from leechem import spatial
+from leechem.bench import synthetic
+
+BAD = [[np.nan, 0, 0], [0, np.inf, 0], [0, 0, -np.inf]]
+
+@pytest.fixture
+def gi():
+    rng = np.random.default_rng(0)
+    return spatial.GridIndex(rng.uniform(0, 10, (200, 3)))
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    fn = str(tmp_path_factory.mktemp('db') / 'test.sbemdb')
+    synthetic.make_sbemdb(fn, ntrees=3, nodes=100)
+    return sbemdb.SBEMDB(fn)
+
+@pytest.mark.parametrize('p', BAD)
+def test_within_rejects_nonfinite(gi, p):
+    with pytest.raises(ValueError):
+        gi.within(p, 1.0)
+
+@pytest.mark.parametrize('p', BAD)
+def test_withinmany_rejects_nonfinite(gi, p):
+    with pytest.raises(ValueError):
+        gi.withinMany([[5, 5, 5], p], 1.0)
+
+@pytest.mark.parametrize('p', BAD)
+def test_nearest_rejects_nonfinite(gi, p):
+    with pytest.raises(ValueError):
+        gi.nearest(p, 3)
+    with pytest.raises(ValueError):
+        gi.nearestMany([[5, 5, 5], p], 3)
+
+def test_within_finite(gi):
+    ii, dd = gi.within([5, 5, 5], 2.0)
+    d = np.sqrt(np.sum((gi.xyz - [5, 5, 5])**2, 1))
+    assert sorted(ii) == sorted(np.nonzero(d <= 2.0)[0])
+    assert np.all(np.diff(dd) >= 0)
+
+@pytest.mark.parametrize('p', BAD)
+def test_nodesnear_rejects_nonfinite(db, p):
+    with pytest.raises(ValueError):
+        db.nodesNear(p, 10.0)
+    with pytest.raises(ValueError):
+        db.nodesNearMany([[0, 0, 0], p], 10.0)
+
+@pytest.mark.parametrize('p', BAD)
+def test_nearestnodes_rejects_nonfinite(db, p):
+    with pytest.raises(ValueError):
+        db.nearestNodes(p, 3)